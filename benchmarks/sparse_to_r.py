@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Compares the time taken to hand a sparse matrix to R using scuttle's converter (building a dgCMatrix
+from the CSC arrays) and the previous approach (COO triplets through IntVector/FloatVector, then
+Matrix::sparseMatrix).
+
+Usage: python benchmarks/sparse_to_r.py [CELLS [GENES [DENSITY]]]
+"""
+
+import sys
+import time
+
+import numpy as np
+import rpy2.robjects as robjects
+import rpy2.robjects.packages as rpackages
+import scipy.sparse
+from rpy2.robjects.vectors import FloatVector, IntVector
+
+from scuttle.r import spMatrixToR
+
+
+def coo_triplets_to_r(x):
+    matrix_pkg = rpackages.importr('Matrix')
+    coo_matrix = x.tocoo()
+    return matrix_pkg.sparseMatrix(i=IntVector(coo_matrix.row),
+                                   j=IntVector(coo_matrix.col),
+                                   x=FloatVector(coo_matrix.data),
+                                   dims=IntVector(coo_matrix.shape),
+                                   index1=False)
+
+
+def time_conversion(name, converter, x):
+    start = time.perf_counter()
+    result = converter(x)
+    elapsed = time.perf_counter() - start
+    print(f'{name:>14}: {elapsed:8.3f}s')
+    return result
+
+
+def main():
+    n_cells = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_genes = int(sys.argv[2]) if len(sys.argv) > 2 else 30000
+    density = float(sys.argv[3]) if len(sys.argv) > 3 else 0.002
+    rng = np.random.default_rng(0)
+    # Same layout as a loaded h5ad: cells x genes CSR, float32 counts.  R gets the transpose
+    x = scipy.sparse.random(n_cells, n_genes, density=density, format='csr', dtype=np.float32, random_state=rng,
+                            data_rvs=lambda n: rng.integers(1, 50, n)).T
+    print(f'{n_genes} genes x {n_cells} cells, {x.nnz} non-zero values')
+
+    old = time_conversion('COO triplets', coo_triplets_to_r, x)
+    new = time_conversion('dgCMatrix', spMatrixToR, x)
+    identical = robjects.r['identical'](robjects.r['as'](old, 'dgCMatrix'), new)[0]
+    print(f'Results identical: {identical}')
+
+
+if __name__ == '__main__':
+    main()
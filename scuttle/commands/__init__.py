@@ -18,6 +18,7 @@ import logging
 import sys
 
 from scuttle.commands import annotate, describe, export, filterempty, help, plot, promote, select
+from scuttle.readwrite import DATA_COMPONENTS
 
 
 def add_subcommands_to_parser(parser):
@@ -96,7 +97,8 @@ class CommandParser:
                 if parameter == self._help:
                     # If there's a help command, it should be the only command processed
                     return None, [CommandRun(parsed_args, parameter._execute_verb, parameter._validate_args)]
-                commands.append(CommandRun(parsed_args, parameter._execute_verb, parameter._validate_args))
+                commands.append(CommandRun(parsed_args, parameter._execute_verb, parameter._validate_args,
+                                           parameter._requirements))
             if isinstance(parameter, CommandLineOption):
                 CommandParser._parse_option(parameter, argv, global_namespace)
         return (global_namespace, commands)
@@ -125,6 +127,7 @@ class CommandLineVerb:
         self._tokens = {'subcommand': None}
         self._execute_verb = None
         self._validate_args = None
+        self._requirements = None
 
     def add_option(self, name, *args, **kwargs):
         option = CommandLineOption(name, *args, **kwargs)
@@ -149,6 +152,13 @@ class CommandLineVerb:
     def set_validator(self, validate_function):
         self._validate_args = validate_function
 
+    def set_requirements(self, requirements_function):
+        """
+        requirements_function takes the parsed arguments and returns the parts of the data (see
+        readwrite.DATA_COMPONENTS) that the verb reads or modifies.  Verbs without one get everything
+        """
+        self._requirements = requirements_function
+
     def default_namespace(self):
         namespace = Namespace()
         self.add_defaults(namespace)
@@ -157,7 +167,9 @@ class CommandLineVerb:
     def add_defaults(self, namespace):
         for opt in self.options:
             opt._set_defaults(namespace)
-        if self.subcommands:
+        # A nested verb (eg 'select cells sample') would otherwise forget which verb led to it, when it's
+        # used without its own subcommand
+        if self.subcommands and not hasattr(namespace, 'subcommand'):
             namespace.subcommand = None
 
     def parse(self, argv, global_options, global_namespace, namespace=None):
@@ -272,10 +284,11 @@ class CommandRun:
     CommandParser.parse()
     """
 
-    def __init__(self, args, runner, validator):
+    def __init__(self, args, runner, validator, requirements=None):
         self.args = args
         self.runner = runner
         self.validator = validator
+        self.requirements_function = requirements
 
     def execute(self, *args, **kwargs):
         self.runner(self.args, *args, **kwargs)
@@ -284,6 +297,11 @@ class CommandRun:
         if self.validator:
             self.validator(self.args)
 
+    def requirements(self):
+        if self.requirements_function is None:
+            return DATA_COMPONENTS
+        return set(self.requirements_function(self.args))
+
 
 class DuplicateArgumentError(Exception):
     """
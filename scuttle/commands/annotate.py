@@ -18,13 +18,14 @@
 Manage cell/gene annotations - add from external sources, etc
 """
 
+import glob
 import logging
 import os.path
 
 import pandas as pd
 
 from scuttle import history
-from scuttle.commands.cellecta import assign_tags
+from scuttle.commands.cellecta import assign_tags, barcode
 
 
 def add_to_parser(parser):
@@ -35,11 +36,16 @@ def add_to_parser(parser):
     _add_options(gene_cmd)
     cellecta_cmd = annot_cmd.add_verb('cellecta')
     cellecta_cmd.add_option('--fastqs', destvar='fastqs', nargs=2)
+    cellecta_cmd.add_option('--fastq-manifest', destvar='fastq_manifest')
     cellecta_cmd.add_option('--bc14', destvar='bc14')
     cellecta_cmd.add_option('--bc30', destvar='bc30')
     cellecta_cmd.add_option('--id-suffix', destvar='id_suffix', default='')
+    cellecta_cmd.add_option('--cache-size', destvar='cache_size', type=int, default=barcode.DEFAULT_CACHE_SIZE)
+    cellecta_cmd.add_option('--count', destvar='count', choices=['reads', 'umis'], default='reads')
+    cellecta_cmd.add_option('--min-similarity', destvar='min_similarity', type=float)
     annot_cmd.set_validator(validate_args)
     annot_cmd.set_executor(process)
+    annot_cmd.set_requirements(requirements)
 
 
 def _add_options(command):
@@ -53,8 +59,16 @@ def _add_options(command):
     command.add_option('--replace', destvar='replace', action='store_true')
 
 
+def requirements(args):
+    if args.subcommand == 'cellecta':
+        # The full tag counts are stored in obsm, and the tag names in uns
+        return {'obs', 'obsm', 'uns'}
+    return {'var'} if args.subcommand == 'genes' else {'obs'}
+
+
 def validate_args(args):
     if args.subcommand == 'cellecta':
+        _validate_cellecta_args(args)
         return
     annotations = (args.annot_file is not None,
                    args.annotation is not None)
@@ -73,12 +87,58 @@ def validate_args(args):
         exit(1)
 
 
+def _validate_cellecta_args(args):
+    """
+    Collects the pairs of FASTQs into args.fastq_pairs.  They can come from --fastqs (where READ1 and READ2
+    can each be a comma-separated list or a quoted glob pattern) and/or from --fastq-manifest (a tab-separated
+    file with the READ1 and READ2 filenames of one lane per line)
+    """
+    args.fastq_pairs = []
+    if args.fastqs is not None:
+        read1_files, read2_files = (_expand_fastqs(x) for x in args.fastqs)
+        if len(read1_files) != len(read2_files):
+            logging.critical(f'--fastqs matched {len(read1_files)} READ1 files, but {len(read2_files)} READ2 files')
+            exit(1)
+        args.fastq_pairs.extend(zip(read1_files, read2_files))
+    if args.fastq_manifest is not None:
+        with open(args.fastq_manifest, 'r') as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 2:
+                    logging.critical(f'Line {line_number} of {args.fastq_manifest} should be READ1<tab>READ2')
+                    exit(1)
+                args.fastq_pairs.append(tuple(fields))
+    if not args.fastq_pairs:
+        logging.critical('No FASTQs specified (see --fastqs and --fastq-manifest)')
+        exit(1)
+    for filename in (x for pair in args.fastq_pairs for x in pair):
+        if not os.path.exists(filename):
+            logging.critical(f'FASTQ {filename} does not exist')
+            exit(1)
+    if args.min_similarity is not None and not 0 < args.min_similarity <= 1:
+        logging.critical('--min-similarity must be greater than 0, and at most 1')
+        exit(1)
+
+
+def _expand_fastqs(spec):
+    filenames = []
+    for pattern in spec.split(','):
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            logging.critical(f"No FASTQs match '{pattern}'")
+            exit(1)
+        filenames.extend(matches)
+    return filenames
+
+
 def process(args, data, **kwargs):
     if args.subcommand == 'cellecta':
-        assign_tags.assign_tags(data, args.fastqs, args.bc14, args.bc30, args.id_suffix, kwargs['n_procs'])
-        history.add_history_entry(data, args,
-                                  f'Processed Cellecta tags from FASTQs {os.path.abspath(args.fastqs[0])}'
-                                  f' and {os.path.abspath(args.fastq[1])}')
+        assign_tags.assign_tags(data, args.fastq_pairs, args.bc14, args.bc30, args.id_suffix, kwargs['n_procs'],
+                                args.cache_size, args.count, args.min_similarity)
+        fastq_names = ', '.join(f'{os.path.abspath(r1)} and {os.path.abspath(r2)}' for r1, r2 in args.fastq_pairs)
+        history.add_history_entry(data, args, f'Processed Cellecta tags from FASTQs {fastq_names}')
     else:
         if args.drop:
             description = drop_annotation(data, args.subcommand, args.drop)
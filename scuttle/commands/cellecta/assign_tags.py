@@ -18,39 +18,36 @@
 This module uses the Cellecta viral tags to define clonal lineages among the cells.
 """
 
+import collections
+import contextlib
 import gzip
 import logging
 import multiprocessing
+import os
+import time
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
-from . import barcode
+from scuttle import history
 
+from . import barcode, shared
 
-def _read_sequence(f):
-    if f.readline() == '':
-        return None
-    seq = f.readline()
-    f.readline()
-    f.readline()
-    return seq
+# Read 1 format: [Cell barcode (16bp)][UMI (10bp)][Poly-T]
+_CELL_BARCODE_LENGTH = 16
+_R1_WIDTH = 30
+_R1_ANCHOR = (26, b'TTTT')
+# Read 2 format: [BC14 (14bp)]TGGT[BC30 (30bp)]
+_R2_WIDTH = 48
+_R2_ANCHOR = (14, b'TGGT')
 
-
-def _extract_r1_barcodes(r1):
-    # Read 1 format: [Cell barcode (16bp)][UMI (10bp)][Poly-T]
-    if r1[26:30] == 'TTTT':
-        return r1[:16], r1[16:26]
-    else:
-        return 'N/A', 'N/A'
-
-
-def _extract_r2_barcodes(r2):
-    # Read 2 format: [BC14 (14bp)]TGGT[BC30 (30bp)]
-    if r2[14:18] == 'TGGT':
-        return r2[:14], r2[18:48]
-    else:
-        return 'N/A', 'N/A'
+# FASTQs are decompressed this many bytes at a time
+_BLOCK_SIZE = 16 * 1024 * 1024
+# and read pairs are sent to the workers in batches of this size
+_BATCH_SIZE = 100000
+# Seconds between progress reports while the workers are running
+_PROGRESS_INTERVAL = 30
 
 
 def _load_tags(filename):
@@ -62,58 +59,426 @@ def _load_tags(filename):
     return tags
 
 
-def _next_barcode(read1_fastq, read2_fastq):
-    with gzip.open(read1_fastq, 'rt') as r1:
-        with gzip.open(read2_fastq, 'rt') as r2:
-            while True:
-                read1 = _read_sequence(r1)
-                read2 = _read_sequence(r2)
-                if read1 is None or read2 is None:
-                    break
-                r1_barcodes = _extract_r1_barcodes(read1)
-                if r1_barcodes[0] == 'N/A':
-                    continue
-                r2_barcodes = _extract_r2_barcodes(read2)
-                if r2_barcodes[0] == 'N/A':
-                    continue
-                yield r1_barcodes + r2_barcodes
+def _read_sequences(fastq, width):
+    """
+    Yields the first width bases of every read in a gzipped FASTQ, as 2-d uint8 arrays with one row per read.
+    Reads shorter than width are padded with zeros.  Arrays are as large as will fit in one decompressed block
+    """
+    with gzip.open(fastq, 'rb') as f:
+        leftover = b''
+        while True:
+            block = f.read(_BLOCK_SIZE)
+            buffer = leftover + block
+            if not block:
+                if not buffer:
+                    return
+                if not buffer.endswith(b'\n'):
+                    buffer += b'\n'
+            raw = np.frombuffer(buffer, dtype=np.uint8)
+            newlines = np.flatnonzero(raw == ord('\n'))
+            n_reads = len(newlines) // 4
+            if n_reads == 0 and block:
+                leftover = buffer
+                continue
+            # buffer always starts at the beginning of a record, so the sequence is between the first and
+            # second newlines of each group of four
+            seq_starts = newlines[0:4 * n_reads:4] + 1
+            seq_ends = newlines[1:4 * n_reads:4]
+            positions = seq_starts[:, np.newaxis] + np.arange(width)
+            sequences = raw[np.minimum(positions, len(raw) - 1)]
+            sequences[positions >= seq_ends[:, np.newaxis]] = 0
+            yield sequences
+            if not block:
+                return
+            leftover = buffer[newlines[4 * n_reads - 1] + 1:]
+
+
+def _rebatch(arrays, batch_size):
+    """
+    Regroups the rows of arrays into arrays of exactly batch_size rows (except the last)
+    """
+    pending = []
+    n_pending = 0
+    for array in arrays:
+        pending.append(array)
+        n_pending += len(array)
+        if n_pending >= batch_size:
+            combined = np.concatenate(pending)
+            full_batches = len(combined) // batch_size * batch_size
+            for start in range(0, full_batches, batch_size):
+                yield combined[start:start + batch_size]
+            pending = [combined[full_batches:]]
+            n_pending = len(pending[0])
+    if n_pending > 0:
+        yield np.concatenate(pending)
+
+
+def _has_anchor(reads, anchor):
+    offset, sequence = anchor
+    return (reads[:, offset:offset + len(sequence)] == np.frombuffer(sequence, dtype=np.uint8)).all(axis=1)
+
+
+def _field(reads, start, end):
+    """
+    The bases from start to end of each read, as an array of bytes
+    """
+    return np.ascontiguousarray(reads[:, start:end]).view(f'S{end - start}').ravel()
+
+
+def _read_pairs(read1_fastq, read2_fastq):
+    """
+    Yields batches of read pairs, as (R1 sequences, R2 sequences) - see _read_sequences()
+    """
+    r1_batches = _rebatch(_read_sequences(read1_fastq, _R1_WIDTH), _BATCH_SIZE)
+    r2_batches = _rebatch(_read_sequences(read2_fastq, _R2_WIDTH), _BATCH_SIZE)
+    yield from zip(r1_batches, r2_batches)
+
+
+def _anchored_barcodes(read1, read2, funnel):
+    """
+    Returns the barcodes in the read pairs that have both anchors, as a tuple of arrays (cell barcodes, UMIs,
+    BC14s, BC30s).  The reads, and the reads passing each anchor, are added to funnel
+    """
+    r1_anchored = _has_anchor(read1, _R1_ANCHOR)
+    anchored = r1_anchored & _has_anchor(read2, _R2_ANCHOR)
+    funnel.add({'reads': len(read1), 'r1_anchored': r1_anchored.sum(), 'r2_anchored': anchored.sum()})
+    read1 = read1[anchored]
+    read2 = read2[anchored]
+    return (_field(read1, 0, _CELL_BARCODE_LENGTH), _field(read1, _CELL_BARCODE_LENGTH, 26),
+            _field(read2, 0, 14), _field(read2, 18, 48))
+
+
+def _encode_whitelist(data):
+    """
+    Returns (codes, names) for the cell barcodes in data, where codes is the sorted, 2-bit encoded barcodes
+    (see barcode.encode_bases) and names the barcodes (as bytes) in the same order.  Barcodes that can't be
+    encoded can never match a read, so they're left out
+    """
+    names = np.unique(np.array([cell_bc.rsplit('-', maxsplit=1)[0] for cell_bc in data.obs_names], dtype=bytes))
+    codes, valid = barcode.encode_bases(names, _CELL_BARCODE_LENGTH)
+    if not valid.all():
+        logging.warning(f'Ignoring {(~valid).sum()} cell barcodes that are not {_CELL_BARCODE_LENGTH} bases of'
+                        f' A, C, G, and T')
+    order = np.argsort(codes[valid])
+    return codes[valid][order], names[valid][order]
+
+
+def _filter_whitelist(barcodes, whitelist):
+    """
+    Drops the reads whose cell barcode isn't in whitelist (sorted, encoded cell barcodes), and replaces the
+    cell barcodes of the rest with their position in whitelist
+    """
+    cells, umis, bc14s, bc30s = barcodes
+    codes, valid = barcode.encode_bases(cells, _CELL_BARCODE_LENGTH)
+    positions = np.minimum(np.searchsorted(whitelist, codes), len(whitelist) - 1)
+    listed = valid & (whitelist[positions] == codes)
+    return positions[listed], umis[listed], bc14s[listed], bc30s[listed]
+
+
+class _Funnel:
+    """
+    Counts how many reads make it through each stage, and how long each stage takes, for every worker.  The
+    counters are in shared memory, so that the parent can report on them while the workers are running
+    """
+    COUNTERS = ('reads', 'r1_anchored', 'r2_anchored', 'whitelisted', 'exact_tags', 'corrected_tags',
+                'nearest_tags', 'failed_tags', 'cache_hits', 'cache_misses')
+    TIMERS = ('read_seconds', 'parse_seconds', 'whitelist_seconds', 'tag_seconds')
+    FIELDS = COUNTERS + TIMERS
+
+    def __init__(self, n_workers):
+        # The first row is the parent's, for when it reads the FASTQs itself
+        self._values = multiprocessing.RawArray('d', (n_workers + 1) * len(self.FIELDS))
+        self._n_workers = multiprocessing.Value('i', 0)
+        self._row = None
+
+    def _table(self):
+        return np.frombuffer(self._values, dtype=np.float64).reshape(-1, len(self.FIELDS))
+
+    def claim_row(self):
+        """
+        Called once by the parent (before starting the workers), then once by each worker, to get the row it
+        will count in
+        """
+        with self._n_workers.get_lock():
+            self._row = self._n_workers.value
+            self._n_workers.value += 1
+
+    def add(self, values):
+        row = self._table()[self._row]
+        for name, value in values.items():
+            row[self.FIELDS.index(name)] += value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        yield
+        self.add({name: time.perf_counter() - start})
+
+    def timed(self, iterable, name):
+        """
+        Passes along the items in iterable, adding the time taken to produce each one to timer name
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(name):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def totals(self):
+        totals = dict(zip(self.FIELDS, self._table().sum(axis=0)))
+        return {name: int(totals[name]) for name in self.COUNTERS}, {name: totals[name] for name in self.TIMERS}
+
+    def reads_per_second(self):
+        """
+        The reads each worker has processed per second spent reading, parsing, filtering, and correcting them
+        """
+        table = self._table()[1:]
+        busy = table[:, [self.FIELDS.index(name) for name in self.TIMERS]].sum(axis=1)
+        reads = table[:, self.FIELDS.index('reads')]
+        return np.divide(reads, busy, out=np.zeros_like(reads), where=busy > 0)
 
+    def log(self):
+        counts, seconds = self.totals()
+        reads = max(counts['reads'], 1)
+        logging.info(f"Reads: {counts['reads']:,} parsed, {counts['r1_anchored'] / reads:.1%} with R1 anchor, "
+                     f"{counts['r2_anchored'] / reads:.1%} with both anchors, "
+                     f"{counts['whitelisted'] / reads:.1%} whitelisted")
+        logging.info(f"Tags: {counts['exact_tags']:,} exact, {counts['corrected_tags']:,} corrected, "
+                     f"{counts['nearest_tags']:,} by 3-gram similarity, {counts['failed_tags']:,} failed")
+        rates = self.reads_per_second()
+        logging.info(f"Time: {seconds['read_seconds']:.1f}s reading, {seconds['parse_seconds']:.1f}s parsing, "
+                     f"{seconds['whitelist_seconds']:.1f}s "
+                     f"filtering, {seconds['tag_seconds']:.1f}s correcting tags; "
+                     f"{', '.join(f'{rate:,.0f}' for rate in rates)} reads/sec per worker")
 
-def _filter_confident_tags(cell_counts):
-    conf_tags = {cell: {bc: count for bc, count in cell_counts[cell].items() if count > 1} for cell in cell_counts}
-    return {cell: barcodes for cell, barcodes in conf_tags.items() if len(barcodes) > 0}
+
+def _publish(whitelist, bc14_tags, bc30_tags):
+    """
+    Everything the workers need, in a form that shared.SharedArrays can publish
+    """
+    arrays = {'whitelist': whitelist}
+    arrays.update({f'bc14/{name}': array for name, array in bc14_tags.to_arrays().items()})
+    arrays.update({f'bc30/{name}': array for name, array in bc30_tags.to_arrays().items()})
+    return arrays
+
+
+def _initialize_worker(spec, cache_size, min_similarity, count, funnel):
+    global _shared_memory, _whitelist, _count, _funnel
+    # The tags and whitelist were built by the parent - just attach to them
+    _shared_memory, arrays = shared.attach(spec)
+    corpora = [barcode.TagCorpus.from_arrays({name.split('/', 1)[1]: array for name, array in arrays.items()
+                                              if name.startswith(prefix)})
+               for prefix in ('bc14/', 'bc30/')]
+    barcode.initialize_barcodes(*corpora, cache_size, min_similarity)
+    _whitelist = arrays['whitelist']
+    _count = count
+    _funnel = funnel
+    _funnel.claim_row()
+
+
+def _count_batch(barcodes):
+    """
+    Runs in a worker process: filters one batch of barcodes and counts its tags, keeping track of each
+    stage in the worker's funnel
+    """
+    with _funnel.timer('whitelist_seconds'):
+        barcodes = _filter_whitelist(barcodes, _whitelist)
+    _funnel.add({'whitelisted': len(barcodes[0])})
+    with _funnel.timer('tag_seconds'):
+        counts, stats = barcode.count_molecules(barcodes) if _count == 'umis' else barcode.count(barcodes)
+    _funnel.add(stats)
+    return counts
+
+
+def _count_reads(batch):
+    """
+    Runs in a worker process: counts the tags in one batch of read pairs.  Returns the same counts as
+    barcode.count() (or barcode.count_molecules(), when counting UMIs)
+    """
+    with _funnel.timer('parse_seconds'):
+        barcodes = _anchored_barcodes(*batch, _funnel)
+    return _count_batch(barcodes)
+
+
+def _count_pair(fastqs):
+    """
+    Runs in a worker process: reads a pair of FASTQs and counts all of their tags
+    """
+    batches = _funnel.timed(_read_pairs(*fastqs), 'read_seconds')
+    accumulate = _accumulate_molecules if _count == 'umis' else _accumulate_counts
+    return fastqs, accumulate(_count_reads(batch) for batch in batches)
+
+
+def _report_progress(results, n_pairs, funnel):
+    """
+    Passes along the results of _count_pair, logging as each pair of FASTQs is finished and reporting the
+    funnel every so often
+    """
+    finished = 0
+    last_report = time.monotonic()
+    while True:
+        try:
+            fastqs, result = results.next(timeout=max(0, last_report + _PROGRESS_INTERVAL - time.monotonic()))
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            funnel.log()
+            last_report = time.monotonic()
+            continue
+        finished += 1
+        logging.info(f'Finished {os.path.basename(fastqs[0])} and {os.path.basename(fastqs[1])}'
+                     f' ({finished} of {n_pairs} FASTQ pairs)')
+        yield result
+
+
+def _read_all(fastq_pairs, funnel):
+    """
+    Yields batches of read pairs from every pair of FASTQs in turn, timing the reading in the parent's row of
+    the funnel
+    """
+    for number, fastqs in enumerate(fastq_pairs, 1):
+        yield from funnel.timed(_read_pairs(*fastqs), 'read_seconds')
+        logging.info(f'Read {os.path.basename(fastqs[0])} and {os.path.basename(fastqs[1])}'
+                     f' ({number} of {len(fastq_pairs)} FASTQ pairs)')
+
+
+def _distribute(pool, batches, n_workers, funnel):
+    """
+    Sends batches of read pairs to the workers to be counted, and yields the counts in the same order.  Only a
+    few batches per worker are waiting at any time, so that reading can't get far ahead of counting
+    """
+    pending = collections.deque()
+    last_report = time.monotonic()
+    for batch in batches:
+        pending.append(pool.apply_async(_count_reads, (batch,)))
+        if len(pending) >= 2 * n_workers:
+            yield pending.popleft().get()
+        if time.monotonic() > last_report + _PROGRESS_INTERVAL:
+            funnel.log()
+            last_report = time.monotonic()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _merge_counts(counts):
+    """
+    Combines a list of (keys, reads) arrays into a single (keys, reads), with the reads for each key summed
+    """
+    keys, inverse = np.unique(np.concatenate([k for k, _ in counts]), return_inverse=True)
+    reads = np.bincount(inverse.ravel(), weights=np.concatenate([r for _, r in counts]), minlength=len(keys))
+    return keys, reads.astype(np.int64)
 
 
 def _accumulate_counts(counts):
-    result = {}
+    """
+    Merges the (keys, reads) counted by barcode.count()
+    """
+    pending = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))]
     for count in counts:
-        for cell in count:
-            result.setdefault(cell, {})
-            for bc in count[cell]:
-                result[cell].setdefault(bc, 0)
-                result[cell][bc] += count[cell][bc]
-    return result
-
-
-def assign_tags(data, fastqs, bc14_file, bc30_file, cell_suffix, n_proc=-1):
-    whitelist = set([cell_bc.rsplit('-', maxsplit=1)[0] for cell_bc in data.obs_names])
-    with multiprocessing.Pool(n_proc, barcode.initialize_barcodes, (bc14_file, bc30_file)) as pool:
-        cell_counts = _accumulate_counts(pool.imap_unordered(barcode.count,
-                                         ((bc,) for bc in _next_barcode(*fastqs) if bc[0] in whitelist),
-                                         chunksize=100000))
-    cell_counts = _filter_confident_tags(cell_counts)
-    doublets = pd.Series(np.zeros(data.obs_names.shape, dtype=np.bool_), index=data.obs_names)
-    tags = pd.Series(np.empty(data.obs_names.shape, dtype=str), index=data.obs_names)
-    conf_count = 0
-    doublet_count = 0
-    for cell in cell_counts:
-        if len(cell_counts[cell]) > 1:
-            doublets[f'{cell}{cell_suffix}'] = 1
-            doublet_count += 1
+        pending.append(count)
+        # Merge every so often, so that memory is proportional to the number of distinct cell/tag combinations
+        if len(pending) > 16:
+            pending = [_merge_counts(pending)]
+    return _merge_counts(pending)
+
+
+def _accumulate_molecules(molecules):
+    """
+    Merges the molecule ids counted by barcode.count_molecules()
+    """
+    pending = [np.empty(0, dtype=np.int64)]
+    for batch_molecules in molecules:
+        pending.append(batch_molecules)
+        # Merge every so often, so that memory is proportional to the number of distinct molecules
+        if len(pending) > 16:
+            pending = [np.unique(np.concatenate(pending))]
+    return np.unique(np.concatenate(pending))
+
+
+def _count_matrix(keys, reads, n_cells, bc14_tags, bc30_tags):
+    """
+    Returns a tuple of (cell x tag read counts as a sparse matrix, tag names).  The only tags included are
+    those seen in at least one cell
+    """
+    n_tag_codes = len(bc14_tags.ids) * len(bc30_tags.ids)
+    seen_tags, columns = np.unique(keys % n_tag_codes, return_inverse=True)
+    # Duplicates are summed when converting from COO
+    matrix = scipy.sparse.coo_matrix((reads, (keys // n_tag_codes, columns.ravel())),
+                                     shape=(n_cells, len(seen_tags))).tocsr()
+    tag_names = [f'{bc14_tags.ids[tag // len(bc30_tags.ids)]}:{bc30_tags.ids[tag % len(bc30_tags.ids)]}'
+                 for tag in seen_tags]
+    return matrix, np.array(tag_names, dtype=object)
+
+
+def assign_tags(data, fastq_pairs, bc14_file, bc30_file, cell_suffix, n_proc=-1,
+                cache_size=barcode.DEFAULT_CACHE_SIZE, count='reads', min_similarity=None):
+    """
+    fastq_pairs is a list of (READ1, READ2) filenames, eg one per lane.  count is either 'reads' or 'umis'.
+    See barcode.initialize_barcodes() for min_similarity
+    """
+    whitelist, cell_names = _encode_whitelist(data)
+    bc14_tags = barcode.TagCorpus(bc14_file)
+    bc30_tags = barcode.TagCorpus(bc30_file)
+    n_keys = len(whitelist) * len(bc14_tags.ids) * len(bc30_tags.ids)
+    if count == 'umis' and n_keys >= 2 ** (63 - barcode.UMI_BITS):
+        logging.critical(f'Too many cells and tags ({n_keys:,} combinations) to count UMIs')
+        exit(1)
+    n_workers = n_proc if n_proc > 0 else os.cpu_count()
+    fastq_pairs = [tuple(fastqs) for fastqs in fastq_pairs]
+    logging.info(f'Reading {len(fastq_pairs)} FASTQ pair(s) with {n_workers} processes, counting {count}')
+    funnel = _Funnel(n_workers)
+    funnel.claim_row()
+    # The tags and whitelist are only built once, and shared with all of the workers
+    with shared.SharedArrays(_publish(whitelist, bc14_tags, bc30_tags)) as published, \
+            multiprocessing.Pool(n_workers, _initialize_worker,
+                                 (published.spec, cache_size, min_similarity, count, funnel)) as pool:
+        if len(fastq_pairs) >= n_workers:
+            # Each worker reads whole pairs of FASTQs itself, and only sends back the counts
+            results = _report_progress(pool.imap_unordered(_count_pair, fastq_pairs), len(fastq_pairs), funnel)
         else:
-            tags[f'{cell}{cell_suffix}'] = list(cell_counts[cell])[0]
-            conf_count += 1
-    data.obs['doublet'] = doublets
-    data.obs['tags'] = tags
-    logging.info(f'Confidently assigned cells: {conf_count}')
-    logging.info(f'Putative_doublets: {doublet_count}')
+            # A gzip file can't be split without decompressing it, so there aren't enough pairs to keep every
+            # worker reading.  Instead, this process decompresses them and splits them into reads, and the
+            # workers do everything else
+            results = _distribute(pool, _read_all(fastq_pairs, funnel), n_workers, funnel)
+        if count == 'umis':
+            molecules = _accumulate_molecules(results)
+            logging.info(f'Distinct molecules: {len(molecules)}')
+            keys, reads = np.unique(barcode.molecule_keys(molecules), return_counts=True)
+        else:
+            keys, reads = _accumulate_counts(results)
+    funnel.log()
+    counts, tag_names = _count_matrix(keys, reads, len(whitelist), bc14_tags, bc30_tags)
+
+    # A tag is only trusted if it's seen in more than one read (or UMI)
+    confident = counts.copy()
+    confident.data = (confident.data > 1).astype(np.int8)
+    confident.eliminate_zeros()
+    n_confident = confident.getnnz(axis=1)
+    is_doublet = n_confident > 1
+    assigned = np.flatnonzero(n_confident == 1)
+
+    # Move everything from whitelist order into data's order
+    rows = data.obs_names.get_indexer([cell.decode() + cell_suffix for cell in cell_names])
+    in_data = rows >= 0
+    doublets = np.zeros(data.n_obs, dtype=np.bool_)
+    doublets[rows[in_data & is_doublet]] = True
+    tags = np.full(data.n_obs, '', dtype=object)
+    assigned_tags = tag_names[confident.indices[confident.indptr[assigned]]]
+    tags[rows[assigned][in_data[assigned]]] = assigned_tags[in_data[assigned]]
+    data.obs['doublet'] = pd.Series(doublets, index=data.obs_names)
+    data.obs['tags'] = pd.Series(tags, index=data.obs_names)
+    # Keep all of the counts, so that the assignment can be revisited without going back to the FASTQs
+    data_counts = counts[np.flatnonzero(in_data)].tocoo()
+    data.obsm['cellecta_counts'] = scipy.sparse.csr_matrix(
+        (data_counts.data, (rows[in_data][data_counts.row], data_counts.col)), shape=(data.n_obs, counts.shape[1]))
+    history.set_parameter(data, 'cellecta', 'tags', tag_names)
+    history.set_parameter(data, 'cellecta', 'count', count)
+    funnel_counts, funnel_seconds = funnel.totals()
+    history.set_parameter(data, 'cellecta', 'funnel', funnel_counts)
+    history.set_parameter(data, 'cellecta', 'seconds', funnel_seconds)
+    history.set_parameter(data, 'cellecta', 'reads_per_second', funnel.reads_per_second())
+    logging.info(f'Confidently assigned cells: {len(assigned)}')
+    logging.info(f'Putative_doublets: {is_doublet.sum()}')
+    logging.info(f"Tag correction cache: {funnel_counts['cache_hits']} hits, {funnel_counts['cache_misses']} misses")
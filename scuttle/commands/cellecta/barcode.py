@@ -14,51 +14,221 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
+
 import Levenshtein
 import numpy as np
-import scipy
+
+# Reads are corrected to a tag if they differ at no more than this many positions
+MAX_MISMATCHES = 2
+# Number of distinct sequences (per tag type, per worker) whose correction is remembered
+DEFAULT_CACHE_SIZE = 1000000
+# UMIs are packed into the low bits of a molecule id, 2 bits per base
+UMI_LENGTH = 10
+UMI_BITS = 2 * UMI_LENGTH
+_BASE_CODES = np.full(256, -1, dtype=np.int64)
+_BASE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4)
+# Nearest matches are scored in chunks of (sequences x tags) no bigger than this
+_NEAREST_CHUNK_SIZE = 2 ** 24
 
 
 class TagCorpus:
+    """
+    The tags (id and sequence) from one of the tag files.  Everything is stored in numpy arrays, so that the
+    corpus can be built once and shared with worker processes (see to_arrays() and from_arrays())
+    """
     def __init__(self, filename):
-        self._seqs = []
-        self._id_lookup = {}
+        seqs = []
+        id_lookup = {}
         if filename is not None:
             with open(filename, 'r') as f:
                 for line in f:
                     bc_id, seq = line.rstrip().split('\t')
-                    self._seqs.append(seq)
-                    self._id_lookup[seq] = bc_id
-        self._ngrams = np.zeros((len(self._seqs), 64), dtype=int)
-        xlat = [a + b + c for a in 'ACGT' for b in 'ACGT' for c in 'ACGT']
-        self._xlat = {seq: idx for idx, seq in enumerate(xlat)}
-        for i in range(self._ngrams.shape[0]):
-            seq = self._seqs[i]
-            for j in range(len(seq) - 2):
-                ng = seq[j:j + 3]
-                if ng in self._xlat:
-                    self._ngrams[i, self._xlat[ng]] += 1
+                    seqs.append(seq)
+                    id_lookup[seq] = bc_id
+        # Each distinct id gets an integer code, in the order they appear in the file
+        ids = list(dict.fromkeys(id_lookup.values()))
+        codes = {bc_id: code for code, bc_id in enumerate(ids)}
+        self.ids = np.array(ids, dtype=str)
+        # The distinct sequences, in file order, and the code of each one's id
+        self._seqs = np.array(list(id_lookup), dtype=bytes)
+        self._seq_codes = np.array([codes[bc_id] for bc_id in id_lookup.values()], dtype=np.int64)
+        self._sorted_seqs = np.argsort(self._seqs, kind='stable')
+        self._ngrams = _unit_ngram_profiles(self._seqs)
+        self._build_correction_index()
+
+    _ARRAYS = ('ids', '_seqs', '_seq_codes', '_sorted_seqs', '_ngrams', '_index_keys', '_index_seqs')
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in self._ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Recreates a corpus from the result of to_arrays(), without copying the arrays
+        """
+        corpus = cls.__new__(cls)
+        for name in cls._ARRAYS:
+            setattr(corpus, name, arrays[name])
+        return corpus
 
     def __contains__(self, item):
-        return item in self._id_lookup
+        return self._find(item) >= 0
 
     def __getitem__(self, key):
-        return self._id_lookup[key]
+        idx = self._find(key)
+        if idx < 0:
+            raise KeyError(key)
+        return self.ids[self._seq_codes[idx]]
+
+    def _find(self, sequence):
+        """
+        The index (into self._seqs) of sequence, or -1 if it isn't a tag
+        """
+        needle = sequence.encode()
+        pos = np.searchsorted(self._seqs, needle, sorter=self._sorted_seqs)
+        if pos < len(self._seqs) and self._seqs[self._sorted_seqs[pos]] == needle:
+            return self._sorted_seqs[pos]
+        return -1
+
+    def exact(self, sequences):
+        """
+        Returns a boolean array saying which of an array of sequences (as bytes) are tags
+        """
+        if len(self._seqs) == 0:
+            return np.zeros(len(sequences), dtype=np.bool_)
+        positions = np.minimum(np.searchsorted(self._seqs, sequences, sorter=self._sorted_seqs), len(self._seqs) - 1)
+        return self._seqs[self._sorted_seqs[positions]] == sequences
+
+    def _build_correction_index(self):
+        """
+        Pigeonhole index of the tags: if two sequences differ at no more than MAX_MISMATCHES positions, then
+        at least one of MAX_MISMATCHES + 1 segments must be identical.  self._index_keys is the sorted
+        (length, segment number, segment) keys, and self._index_seqs the tag containing each one, as indices
+        into self._seqs (which is in file order)
+        """
+        keys = []
+        seqs = []
+        for idx, seq in enumerate(self._seqs):
+            for segment, (start, end) in enumerate(_segments(len(seq))):
+                keys.append(_index_key(len(seq), segment, seq[start:end]))
+                seqs.append(idx)
+        keys = np.array(keys, dtype=bytes)
+        order = np.argsort(keys, kind='stable')
+        self._index_keys = keys[order]
+        self._index_seqs = np.array(seqs, dtype=np.int64)[order]
+
+    def correct_code(self, sequence):
+        """
+        Returns the code of sequence's tag if it is one, otherwise of the first tag (in file order) that differs
+        from sequence at no more than MAX_MISMATCHES positions.  Returns -1 if there isn't one
+        """
+        idx = self._find(sequence)
+        if idx >= 0:
+            return self._seq_codes[idx]
+        needle = sequence.encode()
+        candidates = set()
+        for segment, (start, end) in enumerate(_segments(len(needle))):
+            key = _index_key(len(needle), segment, needle[start:end])
+            first = np.searchsorted(self._index_keys, key, side='left')
+            last = np.searchsorted(self._index_keys, key, side='right')
+            candidates.update(self._index_seqs[first:last].tolist())
+        for idx in sorted(candidates):
+            if Levenshtein.hamming(needle, self._seqs[idx]) <= MAX_MISMATCHES:
+                return self._seq_codes[idx]
+        return -1
+
+    def correct(self, sequence):
+        """
+        Returns the id of the first tag (in file order) that differs from sequence at no more than
+        MAX_MISMATCHES positions, or None if there isn't one
+        """
+        code = self.correct_code(sequence)
+        return None if code < 0 else self.ids[code]
 
     def nearest_match(self, needle):
-        ngram = np.zeros((1, 64), dtype=int)
-        for i in range(len(needle) - 2):
-            ng = needle[i:i + 3]
-            if ng in self._xlat:
-                ngram[0, self._xlat[ng]] += 1
-        distances = scipy.spatial.distance.cdist(ngram, self._ngrams, 'cosine')
-        return self._seqs[distances.argmax()]
+        """
+        Returns the tag sequence whose 3-gram profile is most similar to needle's
+        """
+        indices, _similarity = self._nearest(np.array([needle], dtype=bytes))
+        return self._seqs[indices[0]].decode()
+
+    def nearest_codes(self, sequences):
+        """
+        Finds the tag whose 3-gram profile is most similar (by cosine similarity) to each of an array of
+        sequences (as bytes), and returns (codes, similarity).  Ties go to the first tag in the file
+        """
+        indices, similarity = self._nearest(sequences)
+        return self._seq_codes[indices], similarity
+
+    def _nearest(self, sequences):
+        indices = np.zeros(len(sequences), dtype=np.int64)
+        similarity = np.zeros(len(sequences))
+        if len(self._seqs) == 0:
+            return indices, similarity
+        chunk = max(1, _NEAREST_CHUNK_SIZE // len(self._seqs))
+        for start in range(0, len(sequences), chunk):
+            scores = _unit_ngram_profiles(sequences[start:start + chunk]) @ self._ngrams.T
+            indices[start:start + chunk] = scores.argmax(axis=1)
+            similarity[start:start + chunk] = scores[np.arange(len(scores)), indices[start:start + chunk]]
+        return indices, similarity
+
+
+def _unit_ngram_profiles(sequences):
+    """
+    Counts the 3-grams in each of an array of sequences (as bytes), returning one row of 64 counts per sequence,
+    scaled to unit length (so the dot product of two rows is their cosine similarity).  3-grams containing
+    anything other than A, C, G, or T aren't counted
+    """
+    width = sequences.dtype.itemsize
+    profiles = np.zeros((len(sequences), 64))
+    if len(sequences) == 0 or width < 3:
+        return profiles
+    bases = _BASE_CODES[np.frombuffer(sequences.tobytes(), dtype=np.uint8).reshape(len(sequences), width)]
+    ngrams = bases[:, :-2] * 16 + bases[:, 1:-1] * 4 + bases[:, 2:]
+    valid = (bases[:, :-2] >= 0) & (bases[:, 1:-1] >= 0) & (bases[:, 2:] >= 0)
+    rows = np.broadcast_to(np.arange(len(sequences))[:, np.newaxis], ngrams.shape)
+    profiles = np.bincount(rows[valid] * 64 + ngrams[valid], minlength=64 * len(sequences))
+    profiles = profiles.reshape(len(sequences), 64).astype(np.float64)
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    return np.divide(profiles, norms, out=profiles, where=norms > 0)
+
+
+def _index_key(length, segment, bases):
+    return b'%d:%d:%s' % (length, segment, bases)
 
 
-def initialize_barcodes(bc14_filename, bc30_filename):
-    global bc14_tags, bc30_tags
-    bc14_tags = TagCorpus(bc14_filename)
-    bc30_tags = TagCorpus(bc30_filename)
+def _segments(length):
+    """
+    Splits a sequence of the given length into MAX_MISMATCHES + 1 (nearly) equal segments, returned
+    as (start, end) pairs
+    """
+    bounds = [length * i // (MAX_MISMATCHES + 1) for i in range(MAX_MISMATCHES + 2)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def initialize_barcodes(bc14, bc30, cache_size=DEFAULT_CACHE_SIZE, min_similarity=None):
+    """
+    bc14 and bc30 are the TagCorpus for each type of tag.  If min_similarity is given, sequences that can't be
+    error-corrected are assigned to the tag with the most similar 3-gram profile, as long as the (cosine)
+    similarity is at least min_similarity
+    """
+    global bc14_tags, bc30_tags, _correct_bc14, _correct_bc30, _reported_cache_info, _min_similarity
+    bc14_tags = bc14
+    bc30_tags = bc30
+    _min_similarity = min_similarity
+    # The same sequences (including the same sequencing errors) show up over and over, so remember
+    # how each one was corrected - including when it couldn't be
+    _correct_bc14 = functools.lru_cache(maxsize=cache_size)(bc14_tags.correct_code)
+    _correct_bc30 = functools.lru_cache(maxsize=cache_size)(bc30_tags.correct_code)
+    _reported_cache_info = (0, 0)
+
+
+def n_tag_codes():
+    """
+    The number of possible (BC14, BC30) combinations, ie the number of tag codes
+    """
+    return len(bc14_tags.ids) * len(bc30_tags.ids)
 
 
 def error_correct(sequence, tags):
@@ -66,30 +236,102 @@ def error_correct(sequence, tags):
     if sequence in tags:
         return tags[sequence]
 
-    # Error correct - it's faster to iterate through all possible tags and check the distance
-    # than it is to generate all possible variations of this sequence
-    for expected_seq, name in tags.items():
-        if Levenshtein.hamming(sequence, expected_seq) < 3:
-            return name
+    # Error correct - only the tags that share a segment with this sequence can be close enough.
+    # Returns None if error correction failed, and we have no idea what this sequence should be
+    return tags.correct(sequence)
+
+
+def _correct_all(sequences, tags, correct):
+    """
+    Corrects every sequence in an array of bytes, returning (codes, exact, nearest), where exact says which
+    sequences were tags without any correction, and nearest which were assigned by their 3-gram profile.
+    Each distinct sequence is only corrected once
+    """
+    distinct, inverse = np.unique(sequences, return_inverse=True)
+    codes = np.fromiter((correct(seq) for seq in distinct.astype(str)), dtype=np.int64, count=len(distinct))
+    nearest = np.zeros(len(distinct), dtype=np.bool_)
+    if _min_similarity is not None:
+        # Too far from any tag to correct - fall back to the closest 3-gram profile, all at once
+        failed = np.flatnonzero(codes < 0)
+        nearest_codes, similarity = tags.nearest_codes(distinct[failed])
+        close = similarity >= _min_similarity
+        codes[failed[close]] = nearest_codes[close]
+        nearest[failed[close]] = True
+    inverse = inverse.ravel()
+    return codes[inverse], tags.exact(distinct)[inverse], nearest[inverse]
+
+
+def _cache_info_since_last_call():
+    """
+    Returns the (hits, misses) of this worker's correction caches since the last time this was called
+    """
+    global _reported_cache_info
+    totals = [sum(values) for values in zip(_correct_bc14.cache_info()[:2], _correct_bc30.cache_info()[:2])]
+    result = (totals[0] - _reported_cache_info[0], totals[1] - _reported_cache_info[1])
+    _reported_cache_info = tuple(totals)
+    return result
 
-    # Error correct failed, no idea what this sequence should be
-    return None
+
+def _tag_keys(barcodes):
+    """
+    Corrects the tags in barcodes, and returns (keys, UMIs, stats) for the reads where both could be corrected.
+    stats counts the reads whose tags were both exact matches, needed correction, needed a 3-gram match, or
+    couldn't be corrected, along with the correction cache's hits and misses
+    """
+    cells, umis, fourteens, thirties = barcodes
+    bc14_codes, bc14_exact, bc14_nearest = _correct_all(fourteens, bc14_tags, _correct_bc14)
+    bc30_codes, bc30_exact, bc30_nearest = _correct_all(thirties, bc30_tags, _correct_bc30)
+    corrected = (bc14_codes >= 0) & (bc30_codes >= 0)
+    n_exact = int((bc14_exact & bc30_exact).sum())
+    n_nearest = int((corrected & (bc14_nearest | bc30_nearest)).sum())
+    n_corrected = int(corrected.sum())
+    hits, misses = _cache_info_since_last_call()
+    stats = {'exact_tags': n_exact, 'corrected_tags': n_corrected - n_exact - n_nearest, 'nearest_tags': n_nearest,
+             'failed_tags': len(cells) - n_corrected, 'cache_hits': hits, 'cache_misses': misses}
+    tag_codes = bc14_codes[corrected] * len(bc30_tags.ids) + bc30_codes[corrected]
+    return cells[corrected].astype(np.int64) * n_tag_codes() + tag_codes, umis[corrected], stats
 
 
 def count(barcodes):
-    counts = {}
-    for (cell, _umi, fourteen, thirty) in barcodes:
-        bc14_id = error_correct(fourteen, bc14_tags)
-        if bc14_id is None:
-            continue
-        bc30_id = error_correct(thirty, bc30_tags)
-        if bc30_id is None:
-            continue
-        bc = f'{bc14_id}:{bc30_id}'
-
-        # Count reads for each cell/tag combination
-        # If this should ever change to a count of UMIs, store the UMIs in a set and take the len at the end
-        counts.setdefault(cell, {})
-        counts[cell].setdefault(bc, 0)
-        counts[cell][bc] += 1
-    return counts
+    """
+    barcodes is a tuple of arrays (cell codes, UMIs, BC14s, BC30s), where the sequences are bytes.
+
+    Returns a tuple of ((keys, reads), stats).  Each key identifies a cell/tag combination, as
+    cell code * n_tag_codes() + tag code, where the tag code is BC14 code * (number of BC30 ids) + BC30 code.
+    stats is a dict counting the reads with exact, corrected, nearest, and failed tags, and the hits and misses of the
+    correction cache while counting these barcodes
+    """
+    keys, _umis, stats = _tag_keys(barcodes)
+    # Count reads for each cell/tag combination
+    return np.unique(keys, return_counts=True), stats
+
+
+def count_molecules(barcodes):
+    """
+    Like count(), but returns (molecules, stats), where molecules is a sorted array of the distinct
+    molecules in barcodes.  Each molecule id is the key of its cell/tag combination, shifted left by UMI_BITS,
+    with the UMI in the low bits.  Reads with anything other than A, C, G, or T in their UMI are dropped
+    """
+    keys, umis, stats = _tag_keys(barcodes)
+    umi_codes, valid = encode_bases(umis, UMI_LENGTH)
+    return np.unique((keys[valid] << UMI_BITS) | umi_codes[valid]), stats
+
+
+def encode_bases(sequences, length):
+    """
+    Packs an array of sequences (as bytes) into integers, 2 bits per base.  Returns (codes, valid), where valid
+    is False for the sequences that can't be encoded - those that aren't exactly length bases of A, C, G, and T
+    """
+    if len(sequences) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.bool_)
+    bases = _BASE_CODES[np.frombuffer(sequences.tobytes(), dtype=np.uint8).reshape(len(sequences), -1)]
+    valid = (bases >= 0).all(axis=1) & (bases.shape[1] == length)
+    shifts = np.arange(2 * (bases.shape[1] - 1), -1, -2, dtype=np.int64)
+    return (bases << shifts).sum(axis=1), valid
+
+
+def molecule_keys(molecules):
+    """
+    The cell/tag key of each molecule id from count_molecules()
+    """
+    return molecules >> UMI_BITS
@@ -0,0 +1,70 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Publishes numpy arrays to worker processes through a single block of shared memory, so that they're only
+built once (in the parent) and never copied
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_ALIGNMENT = 64
+
+
+class SharedArrays:
+    """
+    Copies a dict of arrays into shared memory.  spec is what the workers need to attach() to them, and is small
+    enough to pass when starting the worker.  The memory is released when the context manager exits
+    """
+    def __init__(self, arrays):
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            offset = -(-size // _ALIGNMENT) * _ALIGNMENT
+            layout[name] = (offset, array.dtype.str, array.shape)
+            size = offset + array.nbytes
+        self._memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, array in arrays.items():
+            offset, dtype, shape = layout[name]
+            view = np.ndarray(shape, dtype=dtype, buffer=self._memory.buf, offset=offset)
+            view[...] = array
+            del view
+        self.spec = (self._memory.name, layout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._memory.close()
+        self._memory.unlink()
+
+
+def attach(spec):
+    """
+    Returns (memory, arrays), where arrays is a dict of read-only views of the arrays published by SharedArrays.
+    memory has to be kept alive as long as the arrays are in use
+    """
+    name, layout = spec
+    memory = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for array_name, (offset, dtype, shape) in layout.items():
+        array = np.ndarray(shape, dtype=dtype, buffer=memory.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[array_name] = array
+    return memory, arrays
@@ -23,13 +23,29 @@ import pandas as pd
 from colorama import Fore, Style
 from scipy.sparse import issparse
 
+from scuttle import metrics
+
 
 def add_to_parser(parser):
     describe_cmd = parser.add_verb('describe')
     describe_cmd.add_option('--verbose', '-v', destvar='verbose', action='store_true')
+    describe_cmd.add_option('--metrics', destvar='metrics', action='store_true')
     history_cmd = describe_cmd.add_verb('history')
     history_cmd.add_option('--verbose', '-v', destvar='verbose', action='store_true')
     describe_cmd.set_executor(process)
+    describe_cmd.set_requirements(requirements)
+
+
+def requirements(args):
+    if args.subcommand == 'history':
+        return {'uns'}
+    # The brief summary only needs the names in obsm, varm, and layers, which don't have to be loaded
+    components = {'obs', 'var'}
+    if args.verbose:
+        components |= {'X', 'uns', 'obsm', 'varm', 'layers'}
+    if args.metrics:
+        components |= {'X', 'uns'}
+    return components
 
 
 def process(args, data, **kwargs):
@@ -39,7 +55,9 @@ def process(args, data, **kwargs):
         if args.verbose:
             _full_summary(data)
         else:
-            _brief_summary(data)
+            _brief_summary(data, kwargs.get('skipped_keys', {}))
+        if args.metrics:
+            _show_metrics(data, kwargs.get('n_procs', 1))
 
 
 def _show_history(data, verbose):
@@ -56,23 +74,42 @@ def _show_history(data, verbose):
             print(f"[{entry['timestamp']}] {Fore.CYAN}{entry['description']}{Fore.RESET}")
 
 
-def _brief_summary(data):
+def _brief_summary(data, skipped_keys):
     print(f'Number of cells: {Fore.CYAN}{Style.BRIGHT}{data.n_obs}{Style.RESET_ALL}')
     print('Cell annotations')
     for x in data.obs_keys(): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
     print('Multi-dimensional per-cell data')
-    for x in data.obsm_keys(): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
+    for x in _component_keys(data, 'obsm', skipped_keys): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
 
     print()
     print(f'Number of genes: {Fore.CYAN}{Style.BRIGHT}{data.n_vars}{Style.RESET_ALL}')
     print('Gene annotations')
     for x in data.var_keys(): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
     print('Multi-dimensional per-gene data')
-    for x in data.varm_keys(): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
+    for x in _component_keys(data, 'varm', skipped_keys): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
 
     print()
     print('Extra layers')
-    for x in data.layers.keys(): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
+    for x in _component_keys(data, 'layers', skipped_keys): print(f'  {Fore.CYAN}{x}{Style.RESET_ALL}')
+
+
+def _component_keys(data, component, skipped_keys):
+    """
+    The names in obsm, varm, or layers - listed from the input file if the component wasn't loaded
+    """
+    if component in skipped_keys:
+        return skipped_keys[component]
+    return list(getattr(data, component).keys())
+
+
+def _show_metrics(data, n_procs):
+    metrics.ensure(data, list(metrics.CELL_METRICS) + list(metrics.GENE_METRICS), n_procs)
+    print()
+    print(f'{Style.BRIGHT}Per-cell QC metrics{Style.RESET_ALL}')
+    for x in metrics.CELL_METRICS: print(_summarize(x, data.obs[x]))
+    print()
+    print(f'{Style.BRIGHT}Per-gene QC metrics{Style.RESET_ALL}')
+    for x in metrics.GENE_METRICS: print(_summarize(x, data.var[x]))
 
 
 def _full_summary(data):
@@ -45,6 +45,7 @@ def add_to_parser(parser):
     bigmtx_cmd.add_argument('filename')
     export_cmd.set_executor(process)
     export_cmd.set_validator(validate)
+    export_cmd.set_requirements(requirements)
 
 
 def process(args, data, **kwargs):
@@ -60,6 +61,16 @@ def process(args, data, **kwargs):
         _save_matrix_to_text_file(args.filename, data)
 
 
+def requirements(args):
+    if args.subcommand == 'cells':
+        return {'obs'}
+    if args.subcommand == 'genes':
+        return {'var'}
+    if args.subcommand == 'loom':
+        return {'X', 'obs', 'var', 'layers'}
+    return {'X', 'obs', 'var'}
+
+
 def validate(args):
     if not args.overwrite and (os.path.isfile(args.filename) or os.path.isdir(args.filename)):
         logging.critical(f'Export to {args.filename} failed, file exists.  Rerun with --overwrite')
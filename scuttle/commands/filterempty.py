@@ -18,10 +18,12 @@
 Run EmptyDrops!
 """
 import logging
+import os
 
+import numpy as np
 import pandas as pd
 
-from scuttle import history
+from scuttle import history, matrixcache, metrics
 from scuttle.commands import plot, select
 
 
@@ -33,6 +35,7 @@ def add_to_parser(parser):
     classic = filter_cmd.add_verb('classic')
     _add_classic_options(classic)
     filter_cmd.set_executor(process)
+    filter_cmd.set_requirements(requirements)
 
 
 def _add_emptydrops_options(parser):
@@ -48,6 +51,9 @@ def _add_emptydrops_options(parser):
     parser.add_option('--expect-cells', destvar='expect_cells', type=int, default=3000)
     parser.add_option('--keep-all', '-k', destvar='keep', action='store_true')
     parser.add_option('--plot', destvar='plot')
+    parser.add_option('--engine', destvar='engine', choices=['r', 'native'], default='r')
+    parser.add_option('--force', destvar='force', action='store_true')
+    parser.add_option('--seed', destvar='seed', type=int, default=0)
 
 
 def _add_classic_options(parser):
@@ -58,6 +64,13 @@ def _add_classic_options(parser):
     parser.add_option('--plot', destvar='plot')
 
 
+def requirements(args):
+    if not args.keep:
+        # Removing barcodes touches everything that's indexed by cell
+        return select.requirements(args)
+    return {'X', 'obs', 'uns'}
+
+
 def process(args, data, **kwargs):
     if args.subcommand is None or args.subcommand == 'emptydrops':
         run_emptydrops(args, data, **kwargs)
@@ -66,8 +79,6 @@ def process(args, data, **kwargs):
 
 
 def run_emptydrops(args, data, **kwargs):
-    from scuttle.r.dropletutils import DropletUtils
-    dropletutils = DropletUtils(n_procs=kwargs['n_procs'])
     use_dirichlet = True
     message = 'Running emptyDrops'
     if args.cellranger:
@@ -77,20 +88,53 @@ def run_emptydrops(args, data, **kwargs):
         args.lower, args.retain = _compute_cr_thresholds(data, args.expect_cells)
         use_dirichlet = False
         args.fdr = 0.01
-    result, metadata = dropletutils.emptyDrops(data, lower=args.lower, niters=args.iters,
-                                               retain=args.retain, use_dirichlet=use_dirichlet)
+    previous = None if args.force else _previous_emptydrops(args, data, use_dirichlet)
+    if previous is not None:
+        comp_lower, comp_alpha, comp_retain, pvalues, totals = previous
+        logging.info('Reusing the emptyDrops p-values from a previous run with the same parameters'
+                     ' (use --force to run the simulation again)')
+        from scuttle.native import dropletutils
+        result = pd.DataFrame({'Total': totals, 'PValue': pvalues,
+                               'FDR': dropletutils.empty_drops_fdr(pvalues, totals, comp_retain)})
+    elif args.engine == 'native':
+        from scuttle.native import dropletutils
+        n_procs = kwargs['n_procs'] if kwargs['n_procs'] > 0 else os.cpu_count()
+        result, metadata = dropletutils.empty_drops(data.X, lower=args.lower, niters=args.iters, retain=args.retain,
+                                                    use_dirichlet=use_dirichlet, n_procs=n_procs, seed=args.seed)
+        comp_lower = metadata['lower']
+        comp_alpha = metadata['alpha']
+        comp_retain = metadata['retain']
+    else:
+        from scuttle.r.dropletutils import DropletUtils
+        dropletutils = DropletUtils.session(n_procs=kwargs['n_procs'])
+        result, metadata = dropletutils.emptyDrops(data, lower=args.lower, niters=args.iters,
+                                                   retain=args.retain, use_dirichlet=use_dirichlet, seed=args.seed)
+        comp_lower = metadata.rx2('lower')[0]
+        comp_alpha = metadata.rx2('alpha')[0]
+        comp_retain = metadata.rx2('retain')[0]
     result.index = data.obs_names
     data.obs['emptydrops_fdr'] = result['FDR']
-    comp_lower = metadata.rx2('lower')[0]
-    comp_alpha = metadata.rx2('alpha')[0]
-    comp_retain = metadata.rx2('retain')[0]
-    description = (f'Ran emptyDrops with lower={comp_lower}, alpha={comp_alpha},'
-                   f' retain={comp_retain}')
+    description = (f"{'Ran' if previous is None else 'Reused'} emptyDrops with lower={comp_lower},"
+                   f' alpha={comp_alpha}, retain={comp_retain}')
     history.add_history_entry(data, args, description)
     history.set_parameter(data, 'emptydrops', 'lower', comp_lower)
     history.set_parameter(data, 'emptydrops', 'alpha', comp_alpha)
     history.set_parameter(data, 'emptydrops', 'retain', comp_retain)
     history.set_parameter(data, 'emptydrops', 'fdr_cutoff', args.fdr)
+    if args.keep:
+        # Enough to recompute FDR later (with a different retain cutoff) without rerunning the simulation.
+        # Once barcodes are removed, the results can't be reused anyway
+        history.set_parameter(data, 'emptydrops', 'engine', args.engine)
+        history.set_parameter(data, 'emptydrops', 'niters', args.iters)
+        history.set_parameter(data, 'emptydrops', 'seed', args.seed)
+        history.set_parameter(data, 'emptydrops', 'dirichlet', use_dirichlet)
+        history.set_parameter(data, 'emptydrops', 'retain_cutoff', -1 if args.retain is None else args.retain)
+        history.set_parameter(data, 'emptydrops', 'fingerprint', matrixcache.fingerprint(data))
+        history.set_parameter(data, 'emptydrops', 'pvalues', result['PValue'].to_numpy(dtype=np.float64))
+        history.set_parameter(data, 'emptydrops', 'totals', result['Total'].to_numpy(dtype=np.float64))
+    elif 'emptydrops' in data.uns_keys():
+        for key in ('fingerprint', 'pvalues', 'totals'):
+            data.uns['emptydrops'].pop(key, None)
     if args.plot is not None:
         plot.barcode_rank(data, args.plot, **kwargs)
     if not args.keep:
@@ -102,6 +146,28 @@ def run_emptydrops(args, data, **kwargs):
         select.process(selection, data)
 
 
+def _previous_emptydrops(args, data, use_dirichlet):
+    """
+    If emptyDrops has already been run on this matrix with the same simulation parameters, returns
+    (lower, alpha, retain, pvalues, totals).  Otherwise, returns None
+    """
+    previous = data.uns.get('emptydrops', {})
+    if 'pvalues' not in previous:
+        return None
+    if (previous['engine'] != args.engine or previous['niters'] != args.iters or previous['lower'] != args.lower
+            or bool(previous['dirichlet']) != use_dirichlet or previous.get('seed') != args.seed):
+        return None
+    if args.retain is None and previous['retain_cutoff'] >= 0:
+        # The knee point wasn't computed last time
+        return None
+    if previous['fingerprint'] != matrixcache.fingerprint(data):
+        logging.info('The matrix has changed since emptyDrops was last run')
+        return None
+    retain = previous['retain'] if args.retain is None else args.retain
+    return (previous['lower'], previous['alpha'], retain, np.asarray(previous['pvalues']),
+            np.asarray(previous['totals']))
+
+
 def run_classic(args, data, **kwargs):
     logging.info('Running classic method of empty cell filtering')
     _, threshold = _compute_cr_thresholds(data, args.expect_cells, args.upper_quant, args.lower_prop)
@@ -126,8 +192,7 @@ def _compute_cr_thresholds(data, expect, upper_quant=0.99, lower_prop=0.1):
     Compute the two emptyDrops thresholds (lower and retain) that
     CellRanger has automagic for
     """
-    if 'total_umis' not in data.obs_keys():
-        data.obs['total_umis'] = pd.Series(data.X.sum(axis=1).getA1(), data.obs_names)
+    metrics.ensure(data, ['total_umis'])
     total_umis = data.obs['total_umis'].sort_values(ascending=False)
     upper_value = total_umis[int(expect * (1 - upper_quant))] * lower_prop
     if len(total_umis) >= 45000:
@@ -64,6 +64,8 @@ def global_help():
       --no-write                          Disables writing of output - any changes to the file will be discarded
       --no-compress                       Disables file compression on output
       --procs NUM, -p NUM                 The number of processors to use.  Only certain analyses can take advantage.
+      --server SOCKET                     Send the commands to a running 'scuttle serve' instead of running them
+                                          here.  Defaults to the SCUTTLE_SERVER environment variable, if set
       --version                           Print Scuttle's version and quit
       --help, -h, -?                      Print this help.  Use "help <command>" to get detailed help for that command
 
@@ -106,6 +108,14 @@ def global_help():
     input formats, or to save a new file, specify the appropriate filename using --output/-o.  H5ad files are compressed
     by default, this can be disabled using --no-compress.  In order to save in a different format, see the export
     subcommand.
+
+    Server mode:
+      scuttle serve [--socket SOCKET] [--cache-size FILES] [--procs NUM]
+
+    Starts a long-running scuttle that keeps scanpy, R, and DropletUtils loaded, and listens for commands from
+    'scuttle --server SOCKET ...' on a Unix socket (default: ~/.scuttle/scuttle.sock).  With --cache-size, the
+    most recently used FILES h5ad files are also kept in memory.  Each command works on its own copy of a cached
+    file, so this takes memory for FILES + 1 loaded files.
     """)
 
 
@@ -119,7 +129,10 @@ def annotate_help():
     Types:
       cells
       genes            Add cell or gene annotations from an external (tab-separated) file
-      cellecta         Process cell barcodes using the Cellecta viral tags, and assign clone ids to cells
+      cellecta         Process cell barcodes using the Cellecta viral tags, and assign clone ids to cells.
+                       The read counts of every tag in every cell are also saved, as obsm['cellecta_counts']
+                       (with the tag names in uns['cellecta']['tags']).  How many reads passed each stage,
+                       and the time spent in each, are saved in uns['cellecta']['funnel'] and ['seconds']
 
     Cells/Genes Options
       --file FILE         The (tab-separated) file to read annotations from
@@ -136,11 +149,21 @@ def annotate_help():
                           will be applied without any reordering whatsoever.
 
     Cellecta Options
-      --fastqs READ1 READ2   The raw reads of the barcode library
+      --fastqs READ1 READ2   The raw reads of the barcode library.  For several lanes, READ1 and READ2 can
+                             each be a comma-separated list, or a quoted glob pattern (eg, 'L*_R1.fastq.gz').
+                             The files are paired in (sorted) order
+      --fastq-manifest FILE  A tab-separated file with the READ1 and READ2 filenames of one lane per line.  Can
+                             be used instead of, or along with, --fastqs
       --bc14 FILE            A tab-separated file containing barcode ids and sequences of the 14bp barcodes
       --bc30 FILE            A tab-separated file containing barcode ids and sequences of the 30bp barcodes
       --id-suffix            This value will be appended to all cell barcodes in the --fastqs, in order to
                              match the data
+      --cache-size N         Each process remembers how up to N distinct barcode sequences were error-corrected,
+                             for each barcode type (default: 1000000)
+      --count {reads,umis}   Count the reads supporting each tag in each cell, or the distinct UMIs (default: reads)
+      --min-similarity S     Barcodes that are more than 2 mismatches from every tag are assigned to the tag with
+                             the most similar 3-gram profile, if its cosine similarity is at least S (between 0
+                             and 1).  By default, these barcodes are discarded
     """)
 
 
@@ -154,6 +177,8 @@ def describe_help():
     Options:
       --verbose, -v       Descibe the metadata in more detail - numerical data is
                           summarized, most frequent categories are shown, etc
+      --metrics           Compute (if necessary) and summarize the QC metrics
+                          (see 'scuttle help select')
 
     If 'describe history' is given, then scuttle's history of operations on the file will be displayed.
     With just 'describe', the data and annotations in the file are described.
@@ -202,6 +227,14 @@ def filter_help():
       --iters ITERS             How many iterations of Monte Carlo p-value estimation? (default: 10000)
       --expect-cells CELLS      Only used when --cellranger is set - number of expected cells (default: 3000)
       --plot FILENAME           Saves a barcoderank plot to FILENAME before removing empty cells
+      --engine {r,native}       Run emptyDrops with the DropletUtils R package, or with scuttle's own
+                                implementation, which doesn't need R and uses --procs processors (default: r)
+      --force                   With --keep-all, the emptyDrops p-values are saved in the file, and reused by
+                                later runs with the same --ambient-cutoff, --iters, --engine, and --seed (so
+                                that changing --fdr or --retain-cutoff is fast).  --force runs the simulation
+                                again
+      --seed SEED               The random seed for the Monte Carlo simulation, so that the p-values are
+                                the same every time (default: 0)
 
     classic Options:
       --expect-cells CELLS      The number of expected cells in the experiment (default: 3000)
@@ -223,6 +256,9 @@ def plot_help():
     Usage:
       scuttle -i FILE plot {barcoderank, dispersiontest} [options] IMAGE
 
+    The format of IMAGE is determined by its extension.  To save the same plot in several formats, give a
+    comma-separated list (eg, ranks.png,ranks.pdf).
+
     Plot types:
       barcoderank         Plots the total UMI count of barcodes, ordered from highest to lowest.
                           Most useful if empty barcodes have been identified but retained (either
@@ -235,6 +271,10 @@ def plot_help():
                           a uniform distribution, and by producing a probability plot to allow a
                           graphical comparison
 
+    barcoderank Options:
+      --engine {native,r} Compute the knee and inflection points with scuttle's own implementation of
+                          DropletUtils' barcodeRanks, or with the DropletUtils R package (default: native)
+
     dispersiontest Options:
       --alpha, -a VALUE   The primary parameter for the Dirichlet Multinomial distribution used
                           by emptyDrops.  Set to 'non-dirichlet' to use a simple multinomial
@@ -255,13 +295,17 @@ def select_help():
 
     Usage:
       scuttle -i FILE select {cells,genes} <expression>
+      scuttle -i FILE select cells [<expression>] {sample COUNT,fraction FRACTION} [by ANNOTATION] [--seed SEED]
+      scuttle -i FILE select cells [<expression>] top COUNT by <expression>
 
     <expression> describes the cells/genes to keep, and is expected to be a comparison involving an annotation that
     already exists.  Annotations can be examined in a file using 'scuttle describe', and can be added with, eg,
-    'scuttle annotate', 'cellxgene prepare', or 'scanpy.pp.calculate_qc_metrics()'. In all expressions, the annotation
-    should be on the left side of the comparison and the constant value it is compared to must be on the right.
+    'scuttle annotate', 'cellxgene prepare', or 'scanpy.pp.calculate_qc_metrics()'. Numeric annotations can be combined
+    with arithmetic (+, -, *, /, //, %, **) before they're compared, eg 'total_umis / num_genes > 2', and comparisons
+    can be chained, eg '100 < num_genes < 1000'.
 
-    The special annotation 'gene' allows access to the gene names (typically symbols) in the file.
+    The special annotation 'gene' allows access to the gene names (typically symbols) in the file, and 'cell' to
+    the cell barcodes (unless the cells have an annotation named 'cell').
     The usual comparison operators (==, !=, <, <=, >, >=) are recognized, as are several special
     operators:
       * 'is' and 'is not' compare the annotation to a regular expression, which must be quoted inside the expression.
@@ -269,6 +313,21 @@ def select_help():
         to both the beginning and end of the string.
       * 'in' and 'not in' take a file with one value per line, and compare the annotation to the values in that file.
         Filenames should be quoted within the expression.
+    For these special operators, the annotation must be on the left and the quoted value on the right.
+
+    When selecting cells, a gene name can be used like an annotation, and stands for that gene's expression in each
+    cell (eg, 'CD3E > 0').  'sum(<gene condition>)' is the total expression, in each cell, of all of the genes that
+    satisfy the condition (written the same way as for 'select genes'), eg 'sum(genes is "MT-") / total_umis < 0.2'.
+    Genes removed by an earlier 'select genes' are not available.
+
+    Several QC metrics are computed from the expression matrix the first time they're used (and then stored as
+    annotations, so they're only recomputed after cells or genes have been removed):
+      * Cells: total_umis, num_genes (genes detected), pct_mito (percent of counts from genes matching '^MT-'),
+        and pct_ribo (genes matching '^RP[SL]')
+      * Genes: num_cells (cells the gene is detected in), pct_cells, and mean_counts
+    All of the metrics in an expression are computed together, in a single pass through the matrix.  An existing
+    annotation with the same name that wasn't computed by scuttle is used as-is.
+
     Comparisons can be grouped together with 'and'/'or' and negated with 'not'. Parentheses can be used to clarify
     order of operations.
 
@@ -277,10 +336,24 @@ def select_help():
     within the expression.  Use two different types of quotes (single and double) for these two
     purposes.
 
+    Instead of an expression, cells can be chosen at random, eg to make a smaller dataset for testing.
+    'select cells sample COUNT' keeps COUNT cells, and 'select cells fraction FRACTION' keeps that fraction
+    (between 0 and 1) of the cells.  With 'by ANNOTATION', cells are sampled separately from each group of cells
+    with the same value of the annotation, ie COUNT cells (or all of them, if there are fewer) or FRACTION of the
+    cells from each group.  The same --seed (default: 0) always chooses the same cells.
+    'select cells top COUNT by <expression>' keeps the COUNT cells with the largest values of a numeric expression
+    (written as above, without the comparison), eg 'top 1000 by total_umis'.  Ties are broken arbitrarily, and cells
+    without a value are never chosen.  Cells removed by an earlier select are not considered, and an expression can
+    come first to choose among the cells that satisfy it, eg "select cells 'num_genes > 200' sample 1000".
+
     Examples:
       select cells 'num_genes > 200'
       select genes 'num_cells < 10'
       select cells '(num_genes > 500) or (is_doublet == False)'
+      select cells 'total_umis / num_genes > 2'
+      select cells 'CD3E > 0 and sum(genes is "MT-") / total_umis < 0.2'
+      select cells sample 500 by sample --seed 1
+      select cells top 10000 by 'total_umis / num_genes'
       select genes 'gene_id in "ensembl_ids_of_interest.txt"'
       select genes 'gene is not "MT-.+"'
     """)
@@ -19,14 +19,23 @@ Module for producing any figures requested
 """
 import logging
 
-import matplotlib.pyplot as plt
-from matplotlib.ticker import EngFormatter
-from scipy import stats
+import numpy as np
+
+from scuttle import matrixcache
+
+# matplotlib and scipy.stats are imported where they're used, so that a scuttle client (see server.py) doesn't
+# pay for them
+
+# Barcode rank curves are reduced to about this many points (on a log scale, it's still smooth)
+_MAX_CURVE_POINTS = 2000
+# Curves with more points than this are rasterized in vector formats
+_RASTERIZE_POINTS = 1000
 
 
 def add_to_parser(parser):
     plot_cmd = parser.add_verb('plot')
     br_cmd = plot_cmd.add_verb('barcoderank')
+    br_cmd.add_option('--engine', destvar='engine', choices=['native', 'r'], default='native')
     br_cmd.add_argument('filename')
     test = plot_cmd.add_verb('dispersiontest')
     test.add_option('--alpha', '-a', destvar='alpha')
@@ -34,11 +43,16 @@ def add_to_parser(parser):
     test.add_option('--sample', destvar='sample', type=int, default=100)
     test.add_argument('filename')
     plot_cmd.set_executor(process)
+    plot_cmd.set_requirements(requirements)
+
+
+def requirements(args):
+    return {'X', 'obs', 'uns'}
 
 
 def process(args, data, **kwargs):
     if args.subcommand == 'barcoderank':
-        barcode_rank(data, args.filename, **kwargs)
+        barcode_rank(data, args.filename, engine=args.engine, **kwargs)
     elif args.subcommand == 'dispersiontest':
         run_dispersion_test(args, data, **kwargs)
 
@@ -56,8 +70,11 @@ def barcode_rank(data, filename, **kwargs):
 
 
 def run_dispersion_test(args, data, **kwargs):
+    import matplotlib.pyplot as plt
+    from scipy import stats
+
     from scuttle.r.dropletutils import DropletUtils
-    dropletutils = DropletUtils(n_procs=kwargs['n_procs'])
+    dropletutils = DropletUtils.session(n_procs=kwargs['n_procs'])
     use_dirichlet = args.alpha != 'non-dirichlet'
     if use_dirichlet:
         if args.alpha is None:
@@ -81,21 +98,52 @@ def run_dispersion_test(args, data, **kwargs):
     logging.info(f'Saving probability plot to {args.filename}')
     fig = plt.figure(figsize=(6, 4), dpi=300)
     stats.probplot(ambient_p, dist='uniform', plot=fig.add_subplot(1, 1, 1))
-    fig.savefig(args.filename, dpi='figure')
-    plt.close(fig)
+    _save_figure(fig, args.filename)
 
 
-def _calculate_ranks(data, lower=100, **kwargs):
-    from scuttle.r.dropletutils import DropletUtils
-    dropletutils = DropletUtils(n_procs=kwargs['n_procs'])
-    ranks, rank_metadata = dropletutils.barcode_ranks(data, lower)
+def _calculate_ranks(data, lower=100, engine='native', **kwargs):
+    if engine == 'native':
+        from scuttle.native import dropletutils
+        ranks, rank_metadata = dropletutils.barcode_ranks_from_totals(matrixcache.barcode_totals(data), lower=lower)
+        knee = rank_metadata['knee']
+        inflect = rank_metadata['inflection']
+    else:
+        from scuttle.r.dropletutils import DropletUtils
+        dropletutils = DropletUtils.session(n_procs=kwargs['n_procs'])
+        ranks, rank_metadata = dropletutils.barcode_ranks(data, lower)
+        knee = rank_metadata.rx2('knee')[0]
+        inflect = rank_metadata.rx2('inflection')[0]
     ranks = ranks.query('total > 0')
     ranks.sort_values('rank', inplace=True)
-    knee = rank_metadata.rx2('knee')[0]
-    inflect = rank_metadata.rx2('inflection')[0]
     return ranks, knee, inflect
 
 
+def _decimate(ranks, *cutoffs):
+    """
+    Reduces ranks (sorted by rank) to roughly _MAX_CURVE_POINTS points, evenly spaced on a log scale.
+    Around each of cutoffs, the last point with total >= cutoff and the one after it are always kept,
+    so that annotations and segments split at those totals are exactly where they'd be with every point
+    """
+    # Tied barcodes share a rank, and so are drawn on top of each other
+    ranks = ranks.drop_duplicates('rank')
+    if len(ranks) <= _MAX_CURVE_POINTS:
+        return ranks
+    rank_values = ranks['rank'].to_numpy()
+    totals = ranks['total'].to_numpy()
+    keep = [np.searchsorted(rank_values, np.geomspace(rank_values[0], rank_values[-1], _MAX_CURVE_POINTS))]
+    for cutoff in cutoffs:
+        if np.isfinite(cutoff):
+            # totals are decreasing
+            last_above = np.searchsorted(-totals, -cutoff, side='right') - 1
+            keep.append([last_above, last_above + 1])
+    keep = np.unique(np.clip(np.concatenate(keep), 0, len(ranks) - 1))
+    return ranks.iloc[keep]
+
+
+def _plot_curve(ax, ranks, color):
+    ax.plot(ranks['rank'], ranks['total'], color, rasterized=len(ranks) > _RASTERIZE_POINTS)
+
+
 def _annotate_point(ax, ranks, cutoff, label):
     point = ranks.query('total >= @cutoff').tail(1)
     ax.annotate(label, (point['rank'], point['total']), xytext=(60, 90),
@@ -114,6 +162,7 @@ def _barcode_rank_emptydrops(data, filename, **kwargs):
     passing_cells = (data.obs['emptydrops_fdr'] <= fdr_cutoff).sum()
 
     ranks, knee, inflect = _calculate_ranks(data, lower, **kwargs)
+    ranks = _decimate(ranks, knee, inflect, retain, lower)
 
     # Manipulate data
     retained = ranks.query('total >= @retain')
@@ -123,9 +172,9 @@ def _barcode_rank_emptydrops(data, filename, **kwargs):
     # Plot it!
     (fig, ax) = _initialize_log_figure(title=f"{passing_cells:,} called Cells from {kwargs['scuttle_file']}",
                                        xlabel='Barcode Ranks', ylabel='UMI Count')
-    ax.plot(retained['rank'], retained['total'], 'k')
-    ax.plot(middle['rank'], middle['total'], 'b')
-    ax.plot(ambient['rank'], ambient['total'], 'grey')
+    _plot_curve(ax, retained, 'k')
+    _plot_curve(ax, middle, 'b')
+    _plot_curve(ax, ambient, 'grey')
     _annotate_point(ax, ranks, knee, 'Knee')
     _annotate_point(ax, ranks, inflect, 'Inflection')
 
@@ -138,8 +187,7 @@ def _barcode_rank_emptydrops(data, filename, **kwargs):
     ax.text(0.05, 0.05, parameter_str, transform=ax.transAxes, fontsize='x-small',
             verticalalignment='bottom', bbox={'boxstyle': 'round', 'facecolor': 'white'})
 
-    fig.savefig(filename, dpi='figure')
-    plt.close(fig)
+    _save_figure(fig, filename)
     return True
 
 
@@ -156,6 +204,7 @@ def _barcode_rank_classic(data, filename, **kwargs):
     passing_cells = (data.obs['total_umis'] >= threshold).sum()
 
     ranks, knee, inflect = _calculate_ranks(data, 50, **kwargs)
+    ranks = _decimate(ranks, knee, inflect, threshold)
 
     # Manipulate data
     retained = ranks.query('total >= @threshold')
@@ -164,8 +213,8 @@ def _barcode_rank_classic(data, filename, **kwargs):
     # Plot it!
     (fig, ax) = _initialize_log_figure(title=f"{passing_cells:,} called Cells from {kwargs['scuttle_file']}",
                                        xlabel='Barcode Ranks', ylabel='UMI Count')
-    ax.plot(retained['rank'], retained['total'], 'k')
-    ax.plot(discarded['rank'], discarded['total'], 'grey')
+    _plot_curve(ax, retained, 'k')
+    _plot_curve(ax, discarded, 'grey')
     _annotate_point(ax, ranks, knee, 'Knee')
     _annotate_point(ax, ranks, inflect, 'Inflection')
 
@@ -179,23 +228,22 @@ def _barcode_rank_classic(data, filename, **kwargs):
     ax.text(0.05, 0.05, parameter_str, transform=ax.transAxes, fontsize='x-small',
             verticalalignment='bottom', bbox={'boxstyle': 'round', 'facecolor': 'white'})
 
-    fig.savefig(filename, dpi='figure')
-    plt.close(fig)
+    _save_figure(fig, filename)
     return True
 
 
 def _barcode_rank_filtered(data, filename, **kwargs):
     ranks, knee, inflect = _calculate_ranks(data, 50, **kwargs)
+    ranks = _decimate(ranks, knee, inflect)
 
     # Plot it!
     (fig, ax) = _initialize_log_figure(title=f"{data.n_obs:,} Cells from {kwargs['scuttle_file']}",
                                        xlabel='Barcode Ranks', ylabel='UMI Count')
-    ax.plot(ranks['rank'], ranks['total'], 'k')
+    _plot_curve(ax, ranks, 'k')
     _annotate_point(ax, ranks, knee, 'Knee')
     _annotate_point(ax, ranks, inflect, 'Inflection')
 
-    fig.savefig(filename, dpi='figure')
-    plt.close(fig)
+    _save_figure(fig, filename)
     return True
 
 
@@ -205,6 +253,9 @@ def _initialize_log_figure(title=None, subtitle=None, xlabel=None, ylabel=None):
 
     Returns the (figure, axes) in a tuple
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import EngFormatter
+
     fig = plt.figure(figsize=(6, 4), dpi=300)
     ax = fig.add_subplot(1, 1, 1)
     if title is not None:
@@ -222,3 +273,14 @@ def _initialize_log_figure(title=None, subtitle=None, xlabel=None, ylabel=None):
     ax.xaxis.set_major_formatter(tick_formatter)
     ax.yaxis.set_major_formatter(tick_formatter)
     return (fig, ax)
+
+
+def _save_figure(fig, filename):
+    """
+    filename can be a comma-separated list, to save the same figure in several formats (eg, 'ranks.png,ranks.pdf')
+    """
+    import matplotlib.pyplot as plt
+
+    for name in filename.split(','):
+        fig.savefig(name, dpi='figure')
+    plt.close(fig)
@@ -19,16 +19,24 @@ Promote cell annotations to proper genes
 """
 import logging
 
+import numpy as np
 import pandas as pd
 from scipy.sparse import csc_matrix, hstack, issparse
 
-from scuttle import history
+from scuttle import history, matrixcache, metrics
+from scuttle.readwrite import DATA_COMPONENTS
 
 
 def add_to_parser(parser):
     promote_cmd = parser.add_verb('promote')
     promote_cmd.add_argument('annotation')
     promote_cmd.set_executor(process)
+    promote_cmd.set_requirements(requirements)
+
+
+def requirements(args):
+    # Adding a gene changes the shape of everything that's indexed by gene
+    return DATA_COMPONENTS
 
 
 def process(args, data, **kwargs):
@@ -42,11 +50,14 @@ def process(args, data, **kwargs):
     logging.debug(f'Gene annotation shape: {data.var.shape}')
     logging.debug(f'New gene shape: {new_gene.shape}')
     logging.debug(f'Adding to gene annotations: {new_gene}')
-    data._n_vars += 1
-    data.var = pd.concat([data.var, new_gene])
     if issparse(data.X):
-        data.X = hstack((data.X, csc_matrix(annot).transpose()), format='csc')
+        x = hstack((data.X, csc_matrix(annot.to_numpy(dtype=float)).transpose()), format='csc')
     else:
-        data.X = pd.merge(data.X, annot, how='left', left_index=True, right_index=True)
+        x = np.hstack((data.X, annot.to_numpy(dtype=float)[:, np.newaxis]))
+    # Everything else that's indexed by gene would no longer line up, so only the cell-indexed parts are kept
+    data._init_as_actual(X=x, obs=data.obs, var=pd.concat([data.var, new_gene]), uns=data.uns, obsm=data.obsm,
+                         obsp=data.obsp)
+    matrixcache.invalidate(data)
+    metrics.invalidate(data)
     del data.obs[args.annotation]
     history.add_history_entry(data, args, f"Promoted cell annotation '{args.annotation}' to a gene")
@@ -15,148 +15,664 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import ast
+import collections
+import concurrent.futures
 import logging
+import operator
+import os
 import re
 import sys
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
-from scuttle import history
+from scuttle import history, matrixcache, metrics
+from scuttle.readwrite import DATA_COMPONENTS
+
+# Expressions are evaluated this many rows at a time, so that intermediate results stay small
+_CHUNK_ROWS = 65536
+_ARITHMETIC = {ast.Add: (operator.add, '+'), ast.Sub: (operator.sub, '-'), ast.Mult: (operator.mul, '*'),
+               ast.Div: (operator.truediv, '/'), ast.FloorDiv: (operator.floordiv, None),
+               ast.Mod: (operator.mod, '%'), ast.Pow: (operator.pow, '**')}
+_COMPARISONS = {ast.Eq: (operator.eq, '=='), ast.NotEq: (operator.ne, '!='), ast.Lt: (operator.lt, '<'),
+                ast.LtE: (operator.le, '<='), ast.Gt: (operator.gt, '>'), ast.GtE: (operator.ge, '>=')}
+_OPERATOR_NAMES = {ast.Is: 'is', ast.IsNot: 'is not', ast.In: 'in', ast.NotIn: 'not in'}
+# The types numexpr computes with natively - anything else (eg, unsigned integers) is left to numpy
+_NUMEXPR_DTYPES = frozenset(np.dtype(dtype) for dtype in (bool, np.int32, np.int64, np.float32, np.float64))
+# How many regular expression results, and factorized annotations, are remembered
+_CACHE_SIZE = 16
+_regex_cache = collections.OrderedDict()
+_factorize_cache = collections.OrderedDict()
 
 
 def add_to_parser(parser):
     select_cmd = parser.add_verb('select')
     cell_cmd = select_cmd.add_verb('cells')
     cell_cmd.add_argument('expression')
+    sample_cmd = cell_cmd.add_verb('sample')
+    sample_cmd.add_argument('count')
+    sample_cmd.add_option('by', destvar='by')
+    sample_cmd.add_option('--seed', destvar='seed', type=int, default=0)
+    fraction_cmd = cell_cmd.add_verb('fraction')
+    fraction_cmd.add_argument('fraction')
+    fraction_cmd.add_option('by', destvar='by')
+    fraction_cmd.add_option('--seed', destvar='seed', type=int, default=0)
+    top_cmd = cell_cmd.add_verb('top')
+    top_cmd.add_argument('count')
+    top_cmd.add_option('by', destvar='by')
     gene_cmd = select_cmd.add_verb('genes')
     gene_cmd.add_argument('expression')
     select_cmd.set_executor(process)
+    select_cmd.set_validator(validate_args)
+    select_cmd.set_requirements(requirements)
+
+
+def requirements(args):
+    # Subsetting changes the shape of everything
+    return DATA_COMPONENTS
+
 
+def validate_args(args):
+    if args.subcommand in ('sample', 'top'):
+        try:
+            args.count = int(args.count)
+        except ValueError:
+            args.count = 0
+        if args.count <= 0:
+            logging.critical(f'The number of cells to select must be a positive integer, not {args.count}')
+            sys.exit(1)
+    if args.subcommand == 'fraction':
+        try:
+            args.fraction = float(args.fraction)
+        except ValueError:
+            args.fraction = 0
+        if not 0 < args.fraction <= 1:
+            logging.critical('The fraction of cells to select must be greater than 0, and at most 1')
+            sys.exit(1)
+    if args.subcommand == 'top' and args.by is None:
+        logging.critical("'select cells top N' needs to know which cells are the top - add 'by <annotation>'")
+        sys.exit(1)
 
-def process(args, data, **kwargs):
+
+def process(args, data, pending_subset=None, **kwargs):
+    """
+    If pending_subset is given, the selection is added to it and the data is left untouched.
+    Otherwise, the data is subset immediately
+    """
+    subset = PendingSubset(data) if pending_subset is None else pending_subset
+    # Cells and genes removed by an earlier (still pending) select can't be referenced, and aren't included
+    # in any metrics computed along the way
+    n_procs = kwargs.get('n_procs', 1)
     if args.subcommand == 'cells':
         tree = ast.parse(args.expression, mode='eval')
-        cell_subset = EvaluateFilter(data, 'cell').visit(tree)
-        s = np.sum(~cell_subset)
+        s = subset.keep_cells(EvaluateFilter(data, 'cell', n_procs, subset.cells, subset.genes).visit(tree))
         logging.info(f'Removed {s} cells')
-        data._inplace_subset_obs(cell_subset)
-    if args.subcommand == 'genes':
+        selected = f"cells that satisfy '{args.expression}'"
+    elif args.subcommand == 'genes':
         tree = ast.parse(args.expression, mode='eval')
-        gene_subset = EvaluateFilter(data, 'gene').visit(tree)
-        s = np.sum(~gene_subset)
+        s = subset.keep_genes(EvaluateFilter(data, 'gene', n_procs, subset.cells, subset.genes).visit(tree))
         logging.info(f'Removed {s} genes')
-        data._inplace_subset_var(gene_subset)
-    description = f"Kept {args.subcommand} that satisfy '{args.expression}' ({data.n_obs} cells x {data.n_vars} genes)"
+        selected = f"genes that satisfy '{args.expression}'"
+    else:
+        # 'select cells <expression> sample N' samples from the cells that satisfy the expression
+        expression = getattr(args, 'expression', None)
+        if expression is not None:
+            tree = ast.parse(expression, mode='eval')
+            s = subset.keep_cells(EvaluateFilter(data, 'cell', n_procs, subset.cells, subset.genes).visit(tree))
+            logging.info(f"Removed {s} cells that don't satisfy '{expression}'")
+        s = subset.keep_cells(_choose_cells(args, data, subset, n_procs))
+        logging.info(f'Removed {s} cells')
+        selected = _describe_choice(args)
+        if expression is not None:
+            selected += f" (of those that satisfy '{expression}')"
+    description = f'Kept {selected} ({subset.n_obs} cells x {subset.n_vars} genes)'
     history.add_history_entry(data, args, description)
+    if pending_subset is None:
+        subset.apply()
+
+
+def _choose_cells(args, data, subset, n_procs):
+    """
+    Returns the mask of cells kept by 'select cells sample/fraction/top'.  Only the cells that are still
+    in subset are candidates
+    """
+    candidates = np.flatnonzero(subset.cells)
+    if args.subcommand == 'top':
+        values = EvaluateFilter(data, 'cell', n_procs, subset.cells, subset.genes).values(args.by)
+        chosen = candidates[_top(values[candidates], args.count)]
+    else:
+        rng = np.random.default_rng(args.seed)
+        if args.by is None:
+            chosen = candidates[rng.choice(len(candidates), _quota(args, len(candidates)), replace=False)]
+        else:
+            codes = _group_codes(EvaluateFilter(data, 'cell', genes=subset.genes).annotation(args.by))
+            chosen = candidates[_sample_groups(codes[candidates], lambda sizes: _quota(args, sizes), rng)]
+    mask = np.zeros(data.n_obs, dtype=bool)
+    mask[chosen] = True
+    return mask
+
+
+def _describe_choice(args):
+    if args.subcommand == 'top':
+        return f"the top {args.count} cells by '{args.by}'"
+    group = '' if args.by is None else f" from each '{args.by}'"
+    if args.subcommand == 'sample':
+        return f'{args.count} random cells{group}'
+    return f'{100 * args.fraction:g}% of the cells{group}, chosen at random'
+
+
+def _quota(args, size):
+    """
+    How many cells to sample from a group of size cells (size can also be an array of group sizes)
+    """
+    if args.subcommand == 'sample':
+        return np.minimum(size, args.count)
+    return np.round(np.multiply(size, args.fraction)).astype(np.intp)
+
+
+def _top(values, count):
+    """
+    Returns the positions of the count largest values (ties are broken arbitrarily), using a partial sort.
+    Missing values are never chosen
+    """
+    positions = np.flatnonzero(~np.isnan(values))
+    if count >= len(positions):
+        return positions
+    return positions[np.argpartition(values[positions], len(positions) - count)[len(positions) - count:]]
+
+
+def _group_codes(column):
+    """
+    A code for each row, saying which group (distinct value of the annotation) it's in.  Missing values make
+    up a group of their own
+    """
+    codes, distinct = _distinct_values(column)
+    return np.arange(len(distinct)) if codes is None else codes
+
+
+def _sample_groups(codes, quota, rng):
+    """
+    Returns the positions of a random sample of quota(size) rows from each group of codes, where size is the
+    number of rows in the group
+    """
+    # Shuffling, then sorting by group (stably), leaves each group's rows together and in random order
+    order = rng.permutation(len(codes))
+    order = order[np.argsort(codes[order], kind='stable')]
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(codes)])
+    rank = np.arange(len(codes)) - np.repeat(starts, sizes)
+    return order[rank < np.repeat(quota(sizes), sizes)]
+
+
+class PendingSubset:
+    """
+    The cells and genes kept by a series of select commands.  Subsetting copies the entire expression
+    matrix, so consecutive selects are combined and the data is only subset once, by apply()
+    """
+    def __init__(self, data):
+        self.data = data
+        self._reset()
+
+    def _reset(self):
+        self.cells = np.ones(self.data.n_obs, dtype=bool)
+        self.genes = np.ones(self.data.n_vars, dtype=bool)
+
+    @property
+    def n_obs(self):
+        return int(self.cells.sum())
+
+    @property
+    def n_vars(self):
+        return int(self.genes.sum())
+
+    def keep_cells(self, mask):
+        """Returns the number of cells newly removed"""
+        mask = np.asarray(mask, dtype=bool)
+        removed = np.sum(self.cells & ~mask)
+        self.cells &= mask
+        return removed
+
+    def keep_genes(self, mask):
+        """Returns the number of genes newly removed"""
+        mask = np.asarray(mask, dtype=bool)
+        removed = np.sum(self.genes & ~mask)
+        self.genes &= mask
+        return removed
+
+    def apply(self):
+        if self.cells.all() and self.genes.all():
+            return
+        # This is what AnnData._inplace_subset_obs does, but subsets both dimensions with a single copy
+        self.data._init_as_actual(self.data[self.cells, self.genes].copy())
+        matrixcache.invalidate(self.data)
+        self._reset()
+
+
+class _Plan:
+    """
+    A compiled piece of a select expression.  evaluate(rows) returns its values for rows (a slice, or an array
+    of row numbers).  numexpr is the same calculation as numexpr source, or None if numexpr can't do it
+    """
+    def __init__(self, evaluate, numexpr=None, is_mask=False, constant=None, series=None, names=None):
+        self.evaluate = evaluate
+        self.numexpr = numexpr
+        self.is_mask = is_mask
+        # Only one of these is set: constant for literal values, and series for annotations
+        self.constant = constant
+        self.series = series
+        # The index, if the annotation is the cell or gene names
+        self.names = names
+
+    @property
+    def is_numeric(self):
+        if self.series is not None:
+            return pd.api.types.is_numeric_dtype(self.series.dtype)
+        return self.constant is None or isinstance(self.constant, (int, float))
 
 
 class EvaluateFilter(ast.NodeVisitor):
-    def __init__(self, data, cell_or_gene):
+    """
+    Compiles a select expression into a plan, then evaluates it a chunk of rows at a time (in several threads),
+    so that no operator needs a temporary as large as the whole annotation.  If numexpr is installed, purely
+    numeric expressions are handed to it instead.
+
+    When selecting cells, genes can be used like annotations (their expression in each cell), as long as they're
+    in the genes mask (default: all genes).  Metrics (see scuttle.metrics) are computed as though the data
+    only had the cells and genes in the masks
+    """
+    def __init__(self, data, cell_or_gene, n_procs=1, cells=None, genes=None):
         self.data = data
         self.use_cells = cell_or_gene == 'cell'
+        self.cells = np.ones(data.n_obs, dtype=bool) if cells is None else cells
+        self.genes = np.ones(data.n_vars, dtype=bool) if genes is None else genes
+        self.n_rows = data.n_obs if self.use_cells else data.n_vars
+        self.n_threads = n_procs if n_procs > 0 else os.cpu_count()
+        self._numexpr_arrays = {}
         ast.NodeVisitor.__init__(self)
 
+    def generic_visit(self, node):
+        logging.critical(f'{type(node).__name__} is not supported in select expressions')
+        sys.exit(1)
+
     def visit_Expression(self, node):
-        return self.visit(node.body)
+        self._ensure_metrics(node)
+        return self.evaluate(self.visit(node.body))
+
+    def values(self, expression):
+        """
+        Returns the values of a numeric expression (eg, 'total_umis / num_genes') for every row
+        """
+        node = ast.parse(expression, mode='eval')
+        self._ensure_metrics(node)
+        plan = self.visit(node.body)
+        if plan.is_mask or not plan.is_numeric:
+            logging.critical(f"'{expression}' must be a number, not a condition or a string")
+            sys.exit(1)
+        if plan.constant is not None:
+            return np.full(self.n_rows, plan.constant, dtype=np.float64)
+        return self._compute(plan, np.float64)
+
+    def _ensure_metrics(self, node):
+        # Every metric in the expression (including inside sum()) is computed in one pass over the matrix
+        names = {child.id for child in ast.walk(node) if isinstance(child, ast.Name)}
+        metrics.ensure(self.data, names, self.n_threads, self.cells, self.genes)
+
+    def evaluate(self, plan):
+        """
+        Returns the boolean mask computed by plan
+        """
+        if plan.constant is not None:
+            return np.full(self.n_rows, bool(plan.constant))
+        if not plan.is_mask:
+            logging.critical('A select expression must be a condition (eg, a comparison), not a value')
+            sys.exit(1)
+        return self._compute(plan, bool)
+
+    def _compute(self, plan, dtype):
+        numexpr = _import_numexpr()
+        if numexpr is not None and plan.numexpr is not None:
+            if self.n_threads > 1:
+                numexpr.set_num_threads(self.n_threads)
+            try:
+                return numexpr.evaluate(plan.numexpr, local_dict=self._numexpr_arrays).astype(dtype, copy=False)
+            except (TypeError, ValueError, NotImplementedError) as e:
+                logging.debug(f'numexpr could not evaluate {plan.numexpr} ({e}), using numpy instead')
+
+        result = np.empty(self.n_rows, dtype=dtype)
+
+        def fill(rows):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[rows] = plan.evaluate(rows)
+
+        chunks = [slice(start, min(start + _CHUNK_ROWS, self.n_rows)) for start in range(0, self.n_rows, _CHUNK_ROWS)]
+        if self.n_threads > 1 and len(chunks) > 1:
+            # numpy releases the GIL for the actual arithmetic and comparisons
+            with concurrent.futures.ThreadPoolExecutor(min(self.n_threads, len(chunks))) as pool:
+                list(pool.map(fill, chunks))
+        else:
+            for rows in chunks:
+                fill(rows)
+        return result
 
     def visit_UnaryOp(self, node):
+        operand = self.visit(node.operand)
         if isinstance(node.op, ast.Not):
-            return np.logical_not(self.visit(node.operand))
+            if operand.constant is not None:
+                return _constant(not operand.constant)
+            # numexpr's ~ is bitwise, except for booleans
+            numexpr = _numexpr_format('~({})', operand) if operand.is_mask else None
+            return _Plan(lambda rows: np.logical_not(operand.evaluate(rows)), numexpr, is_mask=True)
         if isinstance(node.op, ast.USub):
-            return -1 * self.visit(node.operand)
+            self._require_numeric(operand)
+            if operand.constant is not None:
+                return _constant(-operand.constant)
+            return _Plan(lambda rows: np.negative(operand.evaluate(rows)), _numexpr_format('-({})', operand))
         logging.critical('Unary addition and inversion are not supported')
         sys.exit(1)
 
-    def visit_BinaryOp(self, node):
-        logging.critical('Binary operators are not supported')
-        sys.exit(1)
+    def visit_BinOp(self, node):
+        if type(node.op) not in _ARITHMETIC:
+            logging.critical(f'{type(node.op).__name__} is not supported in select expressions')
+            sys.exit(1)
+        function, symbol = _ARITHMETIC[type(node.op)]
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        self._require_numeric(left)
+        self._require_numeric(right)
+        if left.constant is not None and right.constant is not None:
+            return _constant(function(left.constant, right.constant))
+        # numexpr has no floor division
+        numexpr = None if symbol is None else _numexpr_format(f'({{}} {symbol} {{}})', left, right)
+        return _Plan(lambda rows: function(left.evaluate(rows), right.evaluate(rows)), numexpr)
 
     def visit_BoolOp(self, node):
-        if isinstance(node.op, ast.And):
-            result = np.logical_and(self.visit(node.values[0]), self.visit(node.values[1]))
-            if len(node.values) > 2:
-                for _i in range(2, len(node.values)):
-                    result = np.logical_and(result, self.visit(node.values[_i]))
-            return result
-        elif isinstance(node.op, ast.Or):
-            result = np.logical_or(self.visit(node.values[0]), self.visit(node.values[1]))
-            if len(node.values) > 2:
-                for _i in range(2, len(node.values)):
-                    result = np.logical_or(result, self.visit(node.values[_i]))
-            return result
-        return None  # AND and OR are the only possible BoolOps
+        operands = [self.visit(value) for value in node.values]
+        return _combine(operands, isinstance(node.op, ast.And))
 
     def visit_Compare(self, node):
-        if len(node.ops) > 1:
-            logging.critical('Multiple comparisons (ie, 1 < a < 10) are not allowed')
-            sys.exit(1)
-        left = self.visit(node.left)
-        right = self.visit(node.comparators[0])
-        if not isinstance(left, str):
-            logging.critical('The left side of a comparison must be an annotation (n_genes > 200, not 200 < n_genes)')
-            sys.exit(1)
-        return self.filter_data(left, right, node.ops[0])
+        # Chained comparisons (1 < a < 10) are the same as (1 < a) and (a < 10)
+        operands = [self.visit(node.left)] + [self.visit(comparator) for comparator in node.comparators]
+        comparisons = [self.compare(left, op, right) for left, op, right in zip(operands, node.ops, operands[1:])]
+        return comparisons[0] if len(comparisons) == 1 else _combine(comparisons, True)
+
+    def visit_Constant(self, node):
+        return _constant(node.value)
 
+    # Before Python 3.8, literals had their own node types
     def visit_Num(self, node):
-        return node.n
+        return _constant(node.n)
+
+    def visit_Str(self, node):
+        return _constant(node.s)
+
+    def visit_NameConstant(self, node):
+        return _constant(node.value)
 
     def visit_Name(self, node):
-        return node.id
+        return self.annotation(node.id)
 
-    def visit_Str(self, node):
-        return node.s
+    def visit_Call(self, node):
+        # sum(<gene condition>) - the total expression of the matching genes in each cell
+        if not self.use_cells or not isinstance(node.func, ast.Name) or node.func.id != 'sum' \
+                or len(node.args) != 1 or node.keywords:
+            logging.critical('The only function allowed in select expressions is sum(<gene condition>), when'
+                             ' selecting cells')
+            sys.exit(1)
+        gene_filter = EvaluateFilter(self.data, 'gene', self.n_threads, self.cells, self.genes)
+        genes = gene_filter.visit(ast.Expression(node.args[0])) & self.genes
+        return self._column(pd.Series(_gene_set_totals(self.data, genes), index=self.data.obs_names, copy=False))
 
-    def filter_data(self, annotation, target, op):
+    def annotation(self, name):
         if self.use_cells:
-            if annotation not in self.data.obs_keys():
-                logging.critical(f"Annotation '{annotation}' not present in cells")
+            if name == 'cell' and name not in self.data.obs_keys():
+                return self._column(self.data.obs_names.to_series(), self.data.obs_names)
+            if name not in self.data.obs_keys():
+                return self._gene(name)
+            return self._column(self.data.obs[name])
+        # Within sum(), 'genes is ...' reads more naturally
+        if name == 'gene' or (name == 'genes' and name not in self.data.var_keys()):
+            return self._column(self.data.var_names.to_series(), self.data.var_names)
+        if name not in self.data.var_keys():
+            logging.critical(f"Annotation '{name}' not present in genes")
+            sys.exit(1)
+        return self._column(self.data.var[name])
+
+    def _gene(self, name):
+        """
+        The expression of gene name in each cell
+        """
+        index = self.data.var_names.get_indexer_for([name])
+        if len(index) == 0 or index[0] < 0 or not self.genes[index[0]]:
+            logging.critical(f"'{name}' is not an annotation of the cells, or a gene")
+            sys.exit(1)
+        if len(index) > 1:
+            logging.critical(f"Gene '{name}' is not unique")
+            sys.exit(1)
+        return self._column(pd.Series(_gene_values(self.data, index[0]), index=self.data.obs_names, copy=False))
+
+    def _column(self, series, names=None):
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+                values = series.to_numpy(dtype=float, na_value=np.nan)
+            else:
+                values = series.to_numpy()
+            variable = None
+            if values.dtype in _NUMEXPR_DTYPES:
+                variable = f'v{len(self._numexpr_arrays)}'
+                self._numexpr_arrays[variable] = values
+            return _Plan(lambda rows: values[rows], variable, is_mask=values.dtype == bool, series=series)
+        # Only converted from categories (or other objects) a chunk at a time
+        return _Plan(lambda rows: np.asarray(series.array[rows]), is_mask=series.dtype == bool, series=series,
+                     names=names)
+
+    def _require_numeric(self, plan):
+        if not plan.is_numeric:
+            logging.critical('Arithmetic is only possible with numbers and numeric annotations')
+            sys.exit(1)
+
+    def compare(self, left, op, right):
+        if isinstance(op, (ast.Is, ast.IsNot, ast.In, ast.NotIn)):
+            if left.series is None or not isinstance(right.constant, str):
+                logging.critical(f"'{_OPERATOR_NAMES[type(op)]}' needs an annotation on the left and a quoted string"
+                                 ' on the right')
                 sys.exit(1)
-            metric = self.data.obs[annotation]
-            return self.apply_filter(metric, target, op)
+            return self.match(left, op, right.constant)
+        # Constants are converted to match the annotation they're compared to
+        if left.series is not None and right.constant is not None:
+            right = _constant(_coerce(left.series, right.constant))
+        if right.series is not None and left.constant is not None:
+            left = _constant(_coerce(right.series, left.constant))
+        function, symbol = _COMPARISONS[type(op)]
+        if left.constant is not None and right.constant is not None:
+            return _constant(function(left.constant, right.constant))
+        if isinstance(op, (ast.Eq, ast.NotEq)):
+            for column, value in ((left, right), (right, left)):
+                if column.series is not None and isinstance(column.series.dtype, pd.CategoricalDtype) \
+                        and value.constant is not None:
+                    return _category_equals(column.series, value.constant, isinstance(op, ast.Eq))
+        return _Plan(lambda rows: function(left.evaluate(rows), right.evaluate(rows)),
+                     _numexpr_format(f'({{}} {symbol} {{}})', left, right), is_mask=True)
+
+    def match(self, column, op, target):
+        """
+        is/is not/in/not in are tested once for each distinct value of the annotation, and the results are
+        mapped back to the rows through the codes of each row's value
+        """
+        codes, distinct = _distinct_values(column)
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            matches = _regex_matches(distinct, target)
         else:
-            if annotation == 'gene':
-                metric = self.data.var_names.to_series()
+            target_values = pd.read_table(target, header=None).iloc[:, 0]
+            logging.info(f'Read {target_values.size} values from {target}')
+            matches = distinct.isin(target_values)
+        keep = isinstance(op, (ast.Is, ast.In))
+        if codes is None:
+            if not keep:
+                matches = ~matches
+            return _Plan(lambda rows: matches[rows], is_mask=True)
+        # Missing values have a code of -1, and never match
+        lookup = np.append(matches, False) if keep else np.append(~matches, True)
+        return _Plan(lambda rows: lookup[codes[rows]], is_mask=True)
+
+
+def _gene_values(data, gene):
+    """
+    The values of one gene (column of X) in every cell, taken from the CSC matrix so that only the
+    gene's own values are touched
+    """
+    x = matrixcache.csc(data)
+    if not scipy.sparse.issparse(x):
+        return np.asarray(x[:, gene]).ravel()
+    start, end = x.indptr[gene], x.indptr[gene + 1]
+    values = np.zeros(x.shape[0], dtype=x.dtype)
+    values[x.indices[start:end]] = x.data[start:end]
+    return values
+
+
+def _gene_set_totals(data, genes):
+    """
+    The total of the genes in mask genes for every cell, as one (sparse) matrix-vector product
+    """
+    return np.asarray(data.X @ genes.astype(np.float64)).ravel()
+
+
+def _distinct_values(column):
+    """
+    Returns (codes, distinct) for an annotation, where distinct is an Index of its distinct values and codes
+    gives the position of each row's value in distinct (or -1 if it's missing).  For the cell or gene names, codes
+    is None and distinct is the names themselves
+    """
+    if column.names is not None:
+        return None, column.names
+    series = column.series
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy(), series.cat.categories
+    # Annotations are replaced rather than modified, so the same array means the same values.  Keeping the
+    # array in the cache also keeps its address (or id) from being reused.  For numpy dtypes, to_numpy() is a
+    # view of the annotation's own array, so that's what's kept.  Other (extension) arrays are kept as they are,
+    # since to_numpy() would make a new copy every time
+    if isinstance(series.dtype, np.dtype):
+        values = series.to_numpy()
+        key = (values.__array_interface__['data'][0], values.shape, values.strides, values.dtype.str)
+    else:
+        values = series.array
+        key = (id(values), len(values))
+
+    def factorize():
+        codes, uniques = pd.factorize(values)
+        return codes, pd.Index(uniques)
+    return _cached(_factorize_cache, key, values, factorize)
+
+
+def _regex_matches(values, pattern):
+    """
+    Returns a boolean array saying which of the values in an Index match pattern.  An Index can't be modified,
+    so the results are cached for as long as the Index is the same object
+    """
+    regex = re.compile(pattern)
+    return _cached(_regex_cache, (id(values), pattern), values,
+                   lambda: np.fromiter((regex.match(str(value)) is not None for value in values), dtype=bool,
+                                       count=len(values)))
+
+
+def _cached(cache, key, owner, compute):
+    """
+    Returns cache[key], calling compute() to fill it in if needed.  owner is whatever key was derived from, and
+    is kept along with the value so that it can't be garbage collected (and its id reused) while it's cached
+    """
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key][1]
+    value = compute()
+    cache[key] = (owner, value)
+    while len(cache) > _CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def clear_caches():
+    _regex_cache.clear()
+    _factorize_cache.clear()
+
+
+def _constant(value):
+    numexpr = repr(value) if isinstance(value, (bool, int, float)) else None
+    return _Plan(lambda rows: value, numexpr, is_mask=isinstance(value, bool), constant=value)
+
+
+def _numexpr_format(template, *operands):
+    if any(operand.numexpr is None for operand in operands):
+        return None
+    return template.format(*(operand.numexpr for operand in operands))
+
+
+def _coerce(series, value):
+    """
+    Converts a constant from the expression to the type of the annotation it's compared to
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return str(value)
+    if series.dtype == bool:
+        try:
+            return bool(int(value))
+        except ValueError:
+            return value.lower() == 'true'
+    return value
+
+
+def _category_equals(series, value, equal):
+    """
+    Compares a categorical annotation to a constant using the category codes, rather than the values
+    """
+    codes = series.cat.codes.to_numpy()
+    categories = series.cat.categories
+    target = categories.get_loc(value) if value in categories else -2
+    if equal:
+        return _Plan(lambda rows: codes[rows] == target, is_mask=True)
+    return _Plan(lambda rows: codes[rows] != target, is_mask=True)
+
+
+def _combine(operands, conjunction):
+    """
+    Combines masks with and (if conjunction) or or.  Each operand is only evaluated for the rows that could still
+    change the result, so a selective first condition saves work in the rest
+    """
+    constants = [operand.constant for operand in operands if operand.constant is not None]
+    if conjunction and not all(constants) or not conjunction and any(constants):
+        return _constant(not conjunction)
+    operands = [operand for operand in operands if operand.constant is None]
+    if not operands:
+        return _constant(conjunction)
+    if len(operands) == 1:
+        return operands[0]
+    numexpr = None
+    if all(operand.is_mask for operand in operands):
+        symbol = ' & ' if conjunction else ' | '
+        numexpr = _numexpr_format('(' + symbol.join(['{}'] * len(operands)) + ')', *operands)
+
+    def evaluate(rows):
+        mask = np.array(operands[0].evaluate(rows), dtype=bool)
+        for operand in operands[1:]:
+            # For and, only the rows that are still True matter (and the False ones for or)
+            undecided = np.flatnonzero(mask == conjunction)
+            if len(undecided) == 0:
+                break
+            if len(undecided) < len(mask) // 4:
+                subset = undecided + rows.start if isinstance(rows, slice) else rows[undecided]
+                mask[undecided] = operand.evaluate(subset)
+            elif conjunction:
+                mask &= operand.evaluate(rows)
             else:
-                if annotation not in self.data.var_keys():
-                    logging.critical(f"Annotation '{annotation}' not present in genes")
-                    sys.exit(1)
-                metric = self.data.var[annotation]
-            return self.apply_filter(metric, target, op)
-
-    def apply_filter(self, metric, target, op):
-        if isinstance(metric.dtype, pd.CategoricalDtype):
-            target = str(target)
-        elif metric.dtype == bool:
-            try:
-                t = int(target)
-                target = bool(t)
-            except ValueError:
-                target = target.lower() == 'true'
-        if isinstance(op, ast.Eq):
-            return metric == target
-        if isinstance(op, ast.NotEq):
-            return metric != target
-        if isinstance(op, ast.Lt):
-            return metric < target
-        if isinstance(op, ast.LtE):
-            return metric <= target
-        if isinstance(op, ast.Gt):
-            return metric > target
-        if isinstance(op, ast.GtE):
-            return metric >= target
-        if isinstance(op, ast.Is):
-            regex = re.compile(target)
-            return metric.apply(regex.match).notna()
-        if isinstance(op, ast.IsNot):
-            regex = re.compile(target)
-            return metric.apply(regex.match).isna()
-        if isinstance(op, ast.In):
-            targetvalues = pd.read_table(target, squeeze=True, header=None)
-            logging.info(f'Read {targetvalues.size} values from {target}')
-            return metric.isin(targetvalues)
-        if isinstance(op, ast.NotIn):
-            targetvalues = pd.read_table(target, squeeze=True, header=None)
-            logging.info(f'Read {targetvalues.size} values from {target}')
-            return ~metric.isin(targetvalues)
-        return None  # All comparison operators are allowed!
+                mask |= operand.evaluate(rows)
+        return mask
+    return _Plan(evaluate, numexpr, is_mask=True)
+
+
+def _import_numexpr():
+    try:
+        import numexpr
+    except ImportError:
+        return None
+    return numexpr
@@ -66,6 +66,12 @@ def set_parameter(data, algorithm, key, value):
     data.uns[algorithm][key] = value
 
 
+def reset():
+    """Forget about any changes, so that a new set of commands can be run in the same process"""
+    global _dirty_history
+    _dirty_history = False
+
+
 def has_file_changed():
     global _dirty_history
     return _dirty_history
@@ -0,0 +1,108 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Caches values derived from the expression matrix (data.X), such as its per-barcode totals or a copy
+of it that has already been handed to R, for as long as the matrix stays the same.
+
+Anything that modifies data.X should call invalidate(data).  Replacing data.X, or changing its shape,
+is also noticed without that
+"""
+
+import hashlib
+import itertools
+
+import numpy as np
+import scipy.sparse
+
+_versions = itertools.count(1)
+_cached_version = None
+_cached_values = {}
+
+
+def version(data):
+    """
+    A token that changes whenever data.X does
+    """
+    if getattr(data, '_scuttle_x_version', None) is None:
+        invalidate(data)
+    return data._scuttle_x_version, id(data.X), data.shape
+
+
+def invalidate(data):
+    data._scuttle_x_version = next(_versions)
+
+
+def get(data, key, compute):
+    """
+    Returns the cached value for key, calling compute() to create it if this version of data.X
+    hasn't seen key before.  Only values for the most recently used version are kept
+    """
+    global _cached_version
+    current = version(data)
+    if current != _cached_version:
+        _cached_values.clear()
+        _cached_version = current
+    if key not in _cached_values:
+        _cached_values[key] = compute()
+    return _cached_values[key]
+
+
+def barcode_totals(data):
+    """
+    The total count for each barcode (row of data.X), summed in float64 so that large totals are exact
+    """
+    return get(data, 'barcode totals', lambda: np.asarray(data.X.sum(axis=1, dtype=np.float64)).ravel())
+
+
+def csc(data):
+    """
+    data.X in CSC format, for pulling out the values of individual genes (columns).  Dense matrices are
+    returned as they are
+    """
+    if not scipy.sparse.issparse(data.X) or data.X.format == 'csc':
+        return data.X
+    return get(data, 'csc', lambda: data.X.tocsc())
+
+
+def fingerprint(data):
+    """
+    A digest of the contents of data.X, for recognizing a matrix that was seen in a previous run
+    """
+    return get(data, 'fingerprint', lambda: _digest(data.X))
+
+
+def clear():
+    global _cached_version
+    _cached_values.clear()
+    _cached_version = None
+
+
+def _digest(x):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(x.shape).encode())
+    if scipy.sparse.issparse(x):
+        x = x.tocsr()
+        if not x.has_canonical_format:
+            x = x.copy()
+            x.sum_duplicates()
+        arrays = (x.indptr, x.indices, x.data)
+    else:
+        arrays = (np.asarray(x),)
+    for array in arrays:
+        digest.update(array.dtype.str.encode())
+        digest.update(np.ascontiguousarray(array))
+    return digest.hexdigest()
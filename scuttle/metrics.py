@@ -0,0 +1,177 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Quality-control metrics derived from the expression matrix, computed the first time they're needed and stored
+as cell (obs) or gene (var) annotations.
+
+Each stored metric is recorded in uns['qc_metrics'], along with a fingerprint of what it was computed from.
+Subsetting the matrix leaves per-cell metrics correct until genes are removed (and per-gene metrics until
+cells are) - the fingerprint is a digest of the names of the genes (or cells) that were included.  Any other
+change to the matrix has to call invalidate().  Annotations with the same name that scuttle didn't compute are
+never replaced
+"""
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from scuttle import history
+
+MITO_PATTERN = '^MT-'
+RIBO_PATTERN = '^RP[SL]'
+CELL_METRICS = {
+    'total_umis': 'Total counts in the cell',
+    'num_genes': 'Number of genes detected in the cell',
+    'pct_mito': f'Percent of the counts from mitochondrial genes (names matching {MITO_PATTERN})',
+    'pct_ribo': f'Percent of the counts from ribosomal protein genes (names matching {RIBO_PATTERN})',
+}
+GENE_METRICS = {
+    'num_cells': 'Number of cells in which the gene is detected',
+    'pct_cells': 'Percent of cells in which the gene is detected',
+    'mean_counts': 'Mean count of the gene per cell',
+}
+# The matrix is reduced this many rows at a time
+_CHUNK_ROWS = 65536
+
+
+def ensure(data, names, n_procs=1, cells=None, genes=None):
+    """
+    Makes sure that every metric in names (other names are ignored) is present and up to date in data.obs or
+    data.var, computing any that aren't in a single pass over data.X.  If cells or genes (boolean masks) are
+    given, only those cells/genes are included, as though the data had already been subset
+    """
+    cell_names = [name for name in CELL_METRICS if name in names]
+    gene_names = [name for name in GENE_METRICS if name in names]
+    if not cell_names and not gene_names:
+        return
+    cells = np.ones(data.n_obs, dtype=bool) if cells is None else cells
+    genes = np.ones(data.n_vars, dtype=bool) if genes is None else genes
+    cell_print = _fingerprint(data.var_names[genes]) if cell_names else None
+    gene_print = _fingerprint(data.obs_names[cells]) if gene_names else None
+    stale_cell = [name for name in cell_names if _is_stale(data, data.obs, name, _metric_print(name, cell_print))]
+    stale_gene = [name for name in gene_names if _is_stale(data, data.var, name, gene_print)]
+    if not stale_cell and not stale_gene:
+        return
+    logging.info(f"Computing {', '.join(stale_cell + stale_gene)}")
+    values = _reduce(data, cells, genes, stale_cell, stale_gene, n_procs)
+    for name in stale_cell:
+        data.obs[name] = pd.Series(values[name], index=data.obs_names)
+        history.set_parameter(data, 'qc_metrics', name, _metric_print(name, cell_print))
+    for name in stale_gene:
+        data.var[name] = pd.Series(values[name], index=data.var_names)
+        history.set_parameter(data, 'qc_metrics', name, gene_print)
+
+
+def invalidate(data):
+    """
+    Forgets every metric computed from data.X, for when it changes other than by subsetting
+    """
+    for name in data.uns.pop('qc_metrics', {}):
+        annotations = data.obs if name in CELL_METRICS else data.var
+        if name in annotations:
+            del annotations[name]
+
+
+def _is_stale(data, annotations, name, fingerprint):
+    if name not in annotations:
+        return True
+    recorded = data.uns.get('qc_metrics', {})
+    # Someone else's annotation - leave it alone
+    if name not in recorded:
+        return False
+    return recorded[name] != fingerprint
+
+
+def _metric_print(name, fingerprint):
+    # Changing which genes count as mitochondrial or ribosomal changes the metric, too
+    pattern = {'pct_mito': MITO_PATTERN, 'pct_ribo': RIBO_PATTERN}.get(name, '')
+    return f'{fingerprint}{pattern}'
+
+
+def _fingerprint(names):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(pd.util.hash_pandas_object(names, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _reduce(data, cells, genes, cell_metrics, gene_metrics, n_procs):
+    """
+    Computes the requested metrics from data.X, one chunk of cells at a time (in several threads)
+    """
+    x = data.X
+    gene_weights = genes.astype(np.float64)
+    weights = {'total_umis': gene_weights}
+    for name, pattern in (('pct_mito', MITO_PATTERN), ('pct_ribo', RIBO_PATTERN)):
+        if name in cell_metrics:
+            matches = np.asarray(data.var_names.str.match(pattern, case=False)) & genes
+            if not matches.any():
+                logging.warning(f'No gene names match {pattern}, so {name} will be 0')
+            weights[name] = matches.astype(np.float64)
+    cell_weights = cells.astype(np.float64)
+
+    def reduce_chunk(start):
+        end = min(start + _CHUNK_ROWS, data.n_obs)
+        chunk = _rows(x, start, end)
+        detected = scipy.sparse.csr_matrix(((chunk.data != 0).astype(np.float64), chunk.indices, chunk.indptr),
+                                           shape=chunk.shape)
+        result = {}
+        # Sparse matrix-vector products, which release the GIL
+        if cell_metrics:
+            result.update({name: chunk @ weight for name, weight in weights.items()})
+            result['num_genes'] = detected @ gene_weights
+        if gene_metrics:
+            result['gene_totals'] = chunk.T @ cell_weights[start:end]
+            result['num_cells'] = detected.T @ cell_weights[start:end]
+        return start, result
+
+    n_threads = n_procs if n_procs > 0 else os.cpu_count()
+    starts = range(0, max(data.n_obs, 1), _CHUNK_ROWS)
+    with concurrent.futures.ThreadPoolExecutor(max(1, min(n_threads, len(starts)))) as pool:
+        chunks = sorted(pool.map(reduce_chunk, starts), key=lambda chunk: chunk[0])
+
+    values = {}
+    if cell_metrics:
+        totals = np.concatenate([result['total_umis'] for _, result in chunks])
+        values['total_umis'] = totals
+        values['num_genes'] = np.concatenate([result['num_genes'] for _, result in chunks]).astype(np.int64)
+        for name in ('pct_mito', 'pct_ribo'):
+            if name in weights:
+                counts = np.concatenate([result[name] for _, result in chunks])
+                values[name] = np.divide(100 * counts, totals, out=np.zeros_like(totals), where=totals > 0)
+    if gene_metrics:
+        n_cells = max(int(cells.sum()), 1)
+        detected = np.sum([result['num_cells'] for _, result in chunks], axis=0)
+        values['num_cells'] = detected.astype(np.int64)
+        values['pct_cells'] = 100 * detected / n_cells
+        values['mean_counts'] = np.sum([result['gene_totals'] for _, result in chunks], axis=0) / n_cells
+    return values
+
+
+def _rows(x, start, end):
+    """
+    Rows start to end of x, as a CSR matrix.  For a CSR matrix, this shares x's arrays rather than copying them
+    """
+    if scipy.sparse.issparse(x) and x.format == 'csr':
+        first, last = x.indptr[start], x.indptr[end]
+        return scipy.sparse.csr_matrix((x.data[first:last], x.indices[first:last], x.indptr[start:end + 1] - first),
+                                       shape=(end - start, x.shape[1]))
+    return scipy.sparse.csr_matrix(x[start:end])
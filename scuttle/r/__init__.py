@@ -22,26 +22,42 @@ import logging
 import os
 import os.path
 
+import numpy as np
+import rpy2.rinterface as rinterface
 import rpy2.rinterface_lib.callbacks as callbacks
 import rpy2.robjects as robjects
 import rpy2.robjects.numpy2ri as numpy2ri
 import rpy2.robjects.packages as rpackages
 import rpy2.robjects.pandas2ri as pandas2ri
 import scipy
-from rpy2.robjects.vectors import FloatVector, IntVector
 
 
 def spMatrixToR(x):
-    matrix_pkg = rpackages.importr('Matrix')
-    coo_matrix = x.tocoo()
-    numpy2ri.activate()
-    result = matrix_pkg.sparseMatrix(i=IntVector(coo_matrix.row),
-                                     j=IntVector(coo_matrix.col),
-                                     x=FloatVector(coo_matrix.data),
-                                     dims=IntVector(coo_matrix.shape),
-                                     index1=False)
-    numpy2ri.deactivate()
-    return result
+    """
+    Converts a scipy sparse matrix into an R dgCMatrix.  The dgCMatrix is built directly from the CSC
+    arrays, each of which is copied into R with a single memcpy.  Note that the transpose of a CSR matrix
+    (ie, data.X.T) is already CSC, so no conversion is needed in the usual case
+    """
+    rpackages.importr('Matrix')  # Defines the dgCMatrix class
+    methods = rpackages.importr('methods')
+    csc_matrix = x.tocsc()
+    if not csc_matrix.has_canonical_format:
+        # dgCMatrix requires sorted row indices without duplicates
+        csc_matrix.sum_duplicates()
+    # R only has 32-bit integers and doubles
+    int_max = np.iinfo(np.int32).max
+    if csc_matrix.nnz > int_max or max(csc_matrix.shape) > int_max:
+        logging.critical(f'The matrix is too large for R ({csc_matrix.shape[0]:,} x {csc_matrix.shape[1]:,}, with '
+                         f'{csc_matrix.nnz:,} non-zero values); R sparse matrices are limited to {int_max:,}')
+        exit(1)
+    indices = np.ascontiguousarray(csc_matrix.indices, dtype=np.int32)
+    indptr = np.ascontiguousarray(csc_matrix.indptr, dtype=np.int32)
+    values = np.ascontiguousarray(csc_matrix.data, dtype=np.float64)
+    return methods.new('dgCMatrix',
+                       i=rinterface.IntSexpVector.from_memoryview(memoryview(indices)),
+                       p=rinterface.IntSexpVector.from_memoryview(memoryview(indptr)),
+                       x=rinterface.FloatSexpVector.from_memoryview(memoryview(values)),
+                       Dim=rinterface.IntSexpVector(csc_matrix.shape))
 
 
 def noneToNull(x):
@@ -50,6 +66,7 @@ def noneToNull(x):
 
 class ScuttlR:
 
+    _sessions = {}
     r_lib_path = None
     orig_consolewrite_print = None
     orig_consolewrite_warnerror = None
@@ -58,7 +75,7 @@ class ScuttlR:
     converter = None
 
     def __init__(self, required_major=None, required_minor=None, n_procs=-1):
-        self.ncpus = n_procs if n_procs > 0 else 1
+        self.ncpus = self._ncpus(n_procs)
         if required_major is not None:
             self.verify_r_version(required_major, required_minor)
         self._set_lib_path()
@@ -71,6 +88,27 @@ class ScuttlR:
             ScuttlR.converter = ScuttlR.converter + numpy2ri.converter
             ScuttlR.converter = ScuttlR.converter + pandas2ri.converter
 
+    @classmethod
+    def session(cls, n_procs=-1):
+        """
+        Returns the shared instance of this class, creating it on first use.  Initializing R (and
+        loading packages into it) is slow, so commands should use this rather than creating their own.
+        The number of processes is only read when R is asked to do something, so a later command asking
+        for a different number just updates it
+        """
+        if cls not in ScuttlR._sessions:
+            ScuttlR._sessions[cls] = cls(n_procs=n_procs)
+        session = ScuttlR._sessions[cls]
+        ncpus = cls._ncpus(n_procs)
+        if session.ncpus != ncpus:
+            logging.debug(f'Using {ncpus} processes in R (instead of {session.ncpus})')
+            session.ncpus = ncpus
+        return session
+
+    @staticmethod
+    def _ncpus(n_procs):
+        return n_procs if n_procs > 0 else 1
+
     @classmethod
     def _set_r_console_writers(cls):
         if cls.orig_consolewrite_print is None:
@@ -16,13 +16,21 @@
 
 """
 Interfaces with the DropletUtils R package, specifically the emptyDrops function
+
+Raw matrices are mostly barcodes with no UMIs at all, so only the barcodes that actually affect each
+result are sent to R.  Results are returned in the original barcode order, with NaN for anything R
+didn't see
 """
 import logging
 
+import numpy as np
+import pandas as pd
 import rpy2.robjects as ro
 import rpy2.robjects.packages as rpackages
+import scipy.sparse
 
-from scuttle.r import ScuttlR
+from scuttle import matrixcache
+from scuttle.r import ScuttlR, spMatrixToR
 
 
 class DropletUtils(ScuttlR):
@@ -45,45 +53,116 @@ class DropletUtils(ScuttlR):
         logging.info('Installing DropletUtils')
         bioc_manager.install('DropletUtils', ask=False, quiet=True, Ncpus=self.ncpus)
 
-    def emptyDrops(self, data, lower=100, niters=10000, retain=None, use_dirichlet=True, dirichlet_alpha=None):
+    def emptyDrops(self, data, lower=100, niters=10000, retain=None, use_dirichlet=True, dirichlet_alpha=None,
+                   seed=None):
+        totals = barcode_totals(data)
+        tested = np.flatnonzero(totals > lower)
+        # alpha is estimated from the individual ambient barcodes, so they can only be collapsed if it's known
+        collapse = not use_dirichlet or dirichlet_alpha is not None
+
+        def convert():
+            ambient = _select_barcodes(data.X, np.flatnonzero((totals > 0) & (totals <= lower)))
+            if collapse:
+                ambient = _collapse_ambient(ambient, lower)
+            logging.debug(f'Sending {len(tested)} tested and {ambient.shape[0]} ambient barcodes to emptyDrops')
+            return spMatrixToR(scipy.sparse.vstack((_select_barcodes(data.X, tested), ambient), format='csr').T)
+
+        matrix = matrixcache.get(data, ('emptyDrops', lower, collapse), convert)
         with ro.conversion.localconverter(self.converter):
             base = rpackages.importr('base')
             s4v = rpackages.importr('S4Vectors')
             if not use_dirichlet:
                 dirichlet_alpha = ro.r('1/0')[0]  # Infinity!  I can't find a way to get Inf in rpy2
-            raw_result = self.droplet_utils.emptyDrops(data.X.T, lower=lower, niters=niters, retain=retain,
+            if seed is not None:
+                base.set_seed(seed)
+            raw_result = self.droplet_utils.emptyDrops(matrix, lower=lower, niters=niters, retain=retain,
                                                        alpha=dirichlet_alpha, **{'test.ambient': False})
             # raw_result is a DataFrame from the S4Vectors package, not a data.frame from base R
             pandas_result = ro.conversion.rpy2py(base.as_data_frame(raw_result))
             metadata = s4v.metadata(raw_result)
-        return pandas_result, metadata
+        # Barcodes that weren't tested (including the ones R never saw) get NaN for everything but the total
+        result = pd.DataFrame(np.nan, index=range(len(totals)), columns=pandas_result.columns)
+        result.iloc[tested] = pandas_result.iloc[:len(tested)].to_numpy()
+        result['Total'] = totals
+        return result, metadata
 
     def classic_filter(self, data, expect=3000, upper_quant=0.99, prop=0.1):
+        # defaultDrops only looks at the total for each barcode
+        totals = barcode_totals(data)
+        nonzero = totals > 0 if np.count_nonzero(totals) > expect else np.ones(len(totals), dtype=bool)
         with ro.conversion.localconverter(self.converter):
-            raw_result = self.droplet_utils.defaultDrops(data.X.T, expected=expect, upper_quant=upper_quant,
-                                                         lower_prop=prop)
-            result = ro.conversion.rpy2py(raw_result)
+            raw_result = self.droplet_utils.defaultDrops(totals[nonzero][np.newaxis, :], expected=expect,
+                                                         upper_quant=upper_quant, lower_prop=prop)
+            result = np.zeros(len(totals), dtype=bool)
+            result[nonzero] = ro.conversion.rpy2py(raw_result)
         return result
 
     def barcode_ranks(self, data, lower=100):
+        # barcodeRanks only looks at the total for each barcode, and ranks from the highest down
+        totals = barcode_totals(data)
+        nonzero = np.flatnonzero(totals > 0)
         with ro.conversion.localconverter(self.converter):
             base = rpackages.importr('base')
             s4v = rpackages.importr('S4Vectors')
-            raw_result = self.droplet_utils.barcodeRanks(data.X.T, lower=lower)
+            raw_result = self.droplet_utils.barcodeRanks(totals[nonzero][np.newaxis, :], lower=lower)
             # raw_result is a DataFrame from the S4Vectors package, not a data.frame from base R
             pandas_result = ro.conversion.rpy2py(base.as_data_frame(raw_result))
             metadata = s4v.metadata(raw_result)
-        return pandas_result, metadata
+        # Empty barcodes are tied for last place
+        result = pd.DataFrame({'rank': len(nonzero) + (len(totals) - len(nonzero) + 1) / 2,
+                               'total': totals,
+                               'fitted': np.nan}, index=range(len(totals)))
+        result.iloc[nonzero] = pandas_result[['rank', 'total', 'fitted']].to_numpy()
+        return result, metadata
 
     def test_ambient_pval(self, data, lower=100, use_dirichlet=True, dirichlet_alpha=None):
+        # Barcodes without any UMIs aren't tested, and contribute nothing to the ambient profile or alpha
+        totals = barcode_totals(data)
+        matrix = matrixcache.get(data, 'nonzero barcodes',
+                                 lambda: spMatrixToR(_select_barcodes(data.X, np.flatnonzero(totals > 0)).T))
         with ro.conversion.localconverter(self.converter):
             base = rpackages.importr('base')
             if not use_dirichlet:
                 dirichlet_alpha = ro.r('1/0')[0]
             elif dirichlet_alpha is not None:
                 dirichlet_alpha = float(dirichlet_alpha)
-            raw_result = self.droplet_utils.testEmptyDrops(data.X.T, lower=lower, alpha=dirichlet_alpha,
+            raw_result = self.droplet_utils.testEmptyDrops(matrix, lower=lower, alpha=dirichlet_alpha,
                                                            test_ambient=True)
             pandas_result = ro.conversion.rpy2py(base.as_data_frame(raw_result))
             pandas_result = pandas_result.query('0 < Total <= @lower')
         return pandas_result['PValue']
+
+
+def barcode_totals(data):
+    """
+    The (rounded, as DropletUtils does) total UMI count of each barcode
+    """
+    return np.round(matrixcache.barcode_totals(data))
+
+
+def _select_barcodes(x, rows):
+    return scipy.sparse.csr_matrix(x[rows])
+
+
+def _collapse_ambient(ambient, lower):
+    """
+    emptyDrops only needs the summed ambient profile (unless it's estimating alpha).  Repackage it
+    into as few barcodes as possible, each with at most lower UMIs so that they're still ambient
+    """
+    profile = np.round(np.asarray(ambient.sum(axis=0)).ravel()).astype(np.int64)
+    chunk = int(lower)
+    if chunk < 1 or profile.sum() == 0:
+        return ambient
+    genes = np.flatnonzero(profile)
+    ends = np.cumsum(profile[genes])
+    starts = ends - profile[genes]
+    # Each gene's UMIs cover the range [start, end), which may span several barcodes
+    first_barcode = starts // chunk
+    spans = (ends - 1) // chunk - first_barcode + 1
+    entry_gene = np.repeat(np.arange(len(genes)), spans)
+    entry_barcode = first_barcode[entry_gene] + np.arange(len(entry_gene)) - np.repeat(np.cumsum(spans) - spans, spans)
+    entry_count = (np.minimum(ends[entry_gene], (entry_barcode + 1) * chunk)
+                   - np.maximum(starts[entry_gene], entry_barcode * chunk))
+    n_barcodes = (ends[-1] - 1) // chunk + 1
+    return scipy.sparse.csr_matrix((entry_count.astype(np.float64), (entry_barcode, genes[entry_gene])),
+                                   shape=(n_barcodes, ambient.shape[1]))
@@ -18,26 +18,41 @@
 readwrite.py - This module is responsible for all import into scuttle, as well as saving h5ad files
 """
 
+import collections
 import logging
+import os
 import os.path
+import tempfile
 
+import h5py
 import pandas as pd
-import scanpy as sc
 
 from scuttle import history
 
+# The top-level parts of an AnnData object that commands can declare they need (see CommandLineVerb.set_requirements)
+DATA_COMPONENTS = frozenset(('X', 'layers', 'obs', 'var', 'obsm', 'varm', 'obsp', 'varp', 'uns', 'raw'))
+
+# These are small, and are needed by nearly everything (names, shape, history), so they're always loaded
+_ALWAYS_LOADED = frozenset(('obs', 'var', 'uns'))
+
 
 class ScuttleIO:
     """
     Encapsulates the argument parsing and delegation of reading/writing
     """
-    def __init__(self):
+    def __init__(self, cache=None):
+        self.cache = cache
         self.input_filename = None
         self.output_filename = None
         self.input_format = None
         self.write_output = True
         self.compress_output = True
         self.args = None
+        self._skipped_components = set()
+        # The names inside each component that wasn't loaded (eg, the names of the layers)
+        self.skipped_keys = {}
+        self._loaded_components = None
+        self._loaded_shape = None
 
     @staticmethod
     def add_options_to_parser(parser):
@@ -58,9 +73,16 @@ class ScuttleIO:
             self.output_filename = args.output
             self.compress_output = args.compress
 
-    def load_data(self):
+    def load_data(self, components=DATA_COMPONENTS):
+        """
+        Loads the input file.  For h5ad input, only the parts of the file listed in components
+        (plus obs, var, and uns) are read into memory - the rest are copied straight from the
+        input file when the data is saved
+        """
         logging.info(f'Loading {self.input_filename} ({self.input_format} format)')
-        data = self._load()
+        data = self._load(components)
+        self._loaded_shape = data.shape
+        self.skipped_keys = self._list_skipped_keys()
         if self.input_format != 'h5ad':
             description = (f'Imported {self.input_format} data from {os.path.abspath(self.input_filename)}'
                            f' ({data.n_obs} cells x {data.n_vars} genes)')
@@ -72,14 +94,58 @@ class ScuttleIO:
         if not self.write_output:
             return
         logging.info(f'Saving {data.n_obs} cells and {data.n_vars} genes to {self.output_filename}')
-        data.write(self.output_filename, compression='gzip' if self.compress_output else None)
+        compression = 'gzip' if self.compress_output else None
+        if not self._skipped_components:
+            data.write(self.output_filename, compression=compression)
+            self._cache_saved_data(data)
+            return
+        if data.shape != self._loaded_shape:
+            logging.critical(f'The data changed shape, but {sorted(self._skipped_components)} were never loaded.'
+                             ' Refusing to write an inconsistent file')
+            exit(1)
+        # The output is frequently the same as the input, so write to a temporary file and move it into place
+        # once the untouched parts of the input have been copied over
+        output_dir = os.path.dirname(os.path.abspath(self.output_filename))
+        fd, temp_filename = tempfile.mkstemp(suffix='.h5ad', dir=output_dir)
+        os.close(fd)
+        try:
+            data.write(temp_filename, compression=compression)
+            self._splice_skipped_components(temp_filename)
+            # mkstemp makes the file readable only by its owner
+            os.chmod(temp_filename, _replacement_mode(self.output_filename))
+            os.replace(temp_filename, self.output_filename)
+        except BaseException:
+            os.remove(temp_filename)
+            raise
+        self._cache_saved_data(data)
+
+    def _cache_saved_data(self, data):
+        # The saved file is often the input to the next command sent to the server
+        if self.cache is not None and self._loaded_components is not None:
+            self.cache.put(self.output_filename, self._loaded_components, data, self._skipped_components)
+
+    def _list_skipped_keys(self):
+        if not self._skipped_components:
+            return {}
+        with h5py.File(self.input_filename, 'r') as f:
+            return {key: list(f[key].keys()) if isinstance(f[key], h5py.Group) else []
+                    for key in self._skipped_components}
+
+    def _splice_skipped_components(self, filename):
+        with h5py.File(self.input_filename, 'r') as source, h5py.File(filename, 'a') as dest:
+            for key in self._skipped_components:
+                if key in dest:
+                    del dest[key]
+                source.copy(source[key], dest, name=key)
 
     def canonical_filename(self):
         return self.output_filename if self.write_output else self.input_filename
 
-    def _load(self):
+    def _load(self, components):
+        # scanpy is slow to import, and isn't needed when scuttle is just a client of the server
+        import scanpy as sc
         if self.input_format == 'h5ad':
-            return sc.read_h5ad(self.input_filename)
+            return self._load_h5ad(components)
         elif self.input_format == 'loom':
             return sc.read_loom(self.input_filename)
         elif self.input_format == '10x':
@@ -90,7 +156,38 @@ class ScuttleIO:
             return self._load_bustools_count()
         return None
 
+    def _load_h5ad(self, components):
+        components = frozenset(components) | _ALWAYS_LOADED
+        self._loaded_components = components
+        if self.cache is not None:
+            cached = self.cache.get(self.input_filename, components)
+            if cached is not None:
+                logging.debug(f'Using cached copy of {self.input_filename}')
+                data, self._loaded_components, self._skipped_components = cached
+                return data
+        data = self._read_h5ad(components)
+        if self.cache is not None:
+            self.cache.put(self.input_filename, components, data.copy(), self._skipped_components)
+        return data
+
+    def _read_h5ad(self, components):
+        import anndata
+        import scanpy as sc
+        if components >= DATA_COMPONENTS or 'raw' in components:
+            return sc.read_h5ad(self.input_filename)
+        with h5py.File(self.input_filename, 'r') as f:
+            # Files written by anndata < 0.8 don't record how each element is encoded, and can't be read piecemeal
+            if f.attrs.get('encoding-type') != 'anndata':
+                return sc.read_h5ad(self.input_filename)
+            present = set(f.keys())
+            elements = {key: _read_elem(f[key]) for key in components & present}
+        self._skipped_components = present - components
+        if self._skipped_components:
+            logging.debug(f'Not loading {sorted(self._skipped_components)}, they will be copied on save')
+        return anndata.AnnData(**elements)
+
     def _load_10x(self):
+        import scanpy as sc
         data = sc.read_10x_h5(self.input_filename) if (
             self.input_filename.endswith('.h5')) else (
             sc.read_10x_mtx(self.input_filename))
@@ -98,6 +195,7 @@ class ScuttleIO:
         return data
 
     def _load_bustools_count(self):
+        import scanpy as sc
         data = sc.read_mtx(self.input_filename + '.mtx')
         data.var = pd.read_csv(self.input_filename + '.genes.txt', sep='\t', header=None, index_col=0)
         data.obs = pd.read_csv(self.input_filename + '.barcodes.txt', sep='\t', header=None, index_col=0)
@@ -165,3 +263,66 @@ class ScuttleIO:
             logging.critical(f"'{basename}' does not look like the parameter given to 'bustools count -o'."
                              f' At least one of the mtx, genes.txt, or barcodes.txt files does not exist')
             exit(1)
+
+
+class DataCache:
+    """
+    A least-recently-used cache of loaded h5ad files, used by the scuttle server.  Entries are keyed on the
+    file's modification time and size, so a file that's been rewritten is never served stale.  A cached copy
+    serves any request for the same components or fewer.
+
+    Commands modify the data in place, so every hit hands out a full copy of the cached data - each hit costs
+    about as much memory as the file takes when loaded, on top of the max_files cached copies
+    """
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def _key(filename):
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_mtime_ns, stat.st_size
+
+    def get(self, filename, components):
+        """
+        Returns a (data, loaded_components, skipped_components) tuple, or None if filename isn't cached with
+        at least components loaded.  loaded_components may include more than was asked for
+        """
+        key = self._key(filename)
+        if key not in self._entries:
+            return None
+        data, loaded_components, skipped_components = self._entries[key]
+        if not loaded_components >= frozenset(components):
+            return None
+        self._entries.move_to_end(key)
+        # Commands modify the data in place, so the cached copy must never be handed out
+        return data.copy(), loaded_components, set(skipped_components)
+
+    def put(self, filename, components, data, skipped_components):
+        key = self._key(filename)
+        # Only the latest version of each file is kept
+        for stale_key in [k for k in self._entries if k[0] == key[0]]:
+            del self._entries[stale_key]
+        self._entries[key] = (data, frozenset(components), frozenset(skipped_components))
+        while len(self._entries) > self.max_files:
+            self._entries.popitem(last=False)
+
+
+def _read_elem(elem):
+    try:
+        from anndata.io import read_elem
+    except ImportError:
+        from anndata.experimental import read_elem
+    return read_elem(elem)
+
+
+def _replacement_mode(filename):
+    """
+    The permissions for a file that replaces filename - the same as filename's, or the default for a new file
+    """
+    try:
+        return os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
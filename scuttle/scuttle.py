@@ -16,12 +16,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import sys
 
 import colorama
 
 from scuttle import history, logging
-from scuttle.commands import CommandParser, add_subcommands_to_parser
+from scuttle.commands import CommandParser, add_subcommands_to_parser, select
 from scuttle.readwrite import ScuttleIO
 
 
@@ -37,10 +38,16 @@ def main():
     colorama.init()
     logging.init()
 
+    # The server has its own options, and doesn't process any data itself
+    if sys.argv[1:2] == ['serve']:
+        from scuttle import server
+        server.serve(sys.argv[2:])
+        return
+
     parser = CommandParser()
-    scuttle_io = ScuttleIO()
     ScuttleIO.add_options_to_parser(parser)
     parser.add_global_option('--procs', '-p', destvar='procs', default=-1, type=int)
+    parser.add_global_option('--server', destvar='server', default=os.environ.get('SCUTTLE_SERVER'))
     parser.add_global_option('--version', destvar='version', action='store_true')
     parser.add_global_option('--help', '-h', '-?', destvar='help', action='store_true')
     add_subcommands_to_parser(parser)
@@ -66,12 +73,30 @@ def main():
         print(f"Scuttle v{boilerplate['version'][0]}")
         exit(0)
 
-    scuttle_io.validate_args(global_args)
+    ScuttleIO.validate_args(global_args)
+    if global_args.server is not None:
+        from scuttle import server
+        if server.run_remote(global_args.server, global_args, command_list):
+            return
+    run(global_args, command_list)
+
+
+def run(global_args, command_list, cache=None):
+    """
+    Loads the data, executes every command in command_list, and saves the result
+    """
+    scuttle_io = ScuttleIO(cache)
     scuttle_io.process_arguments(global_args)
-    data = scuttle_io.load_data()
+    data = scuttle_io.load_data(set().union(*(c.requirements() for c in command_list)))
+    pending_subset = select.PendingSubset(data)
     for c in command_list:
         c.validate()
-        c.execute(data, n_procs=global_args.procs, scuttle_file=scuttle_io.canonical_filename())
+        # Selections are deferred until something other than another select needs the data
+        if c.runner is not select.process:
+            pending_subset.apply()
+        c.execute(data, n_procs=global_args.procs, scuttle_file=scuttle_io.canonical_filename(),
+                  pending_subset=pending_subset, skipped_keys=scuttle_io.skipped_keys)
+    pending_subset.apply()
     if history.has_file_changed():
         scuttle_io.save_data(data)
 
@@ -0,0 +1,234 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+server.py - Runs scuttle as a long-lived process, so that importing scanpy and starting R (and DropletUtils)
+only happens once.  Clients (scuttle --server SOCKET ...) parse their command line as usual, then send the
+parsed commands over a Unix socket.  The server runs them one at a time, and sends log messages and
+anything printed back to the client.
+
+Messages are pickled, so the socket is only accessible to the user that started the server.
+"""
+
+import contextlib
+import logging
+import os
+import os.path
+import pickle
+import socket
+import stat
+import struct
+import sys
+
+from scuttle import history, matrixcache
+from scuttle.commands import CommandParser, select
+from scuttle.readwrite import DataCache
+from scuttle.scuttle import run
+
+_HEADER = struct.Struct('>I')
+
+
+def default_socket_path():
+    return os.path.join(os.path.expanduser('~'), '.scuttle', 'scuttle.sock')
+
+
+def serve(argv):
+    parser = CommandParser()
+    parser.add_global_option('--socket', destvar='socket', default=default_socket_path())
+    parser.add_global_option('--cache-size', destvar='cache_size', type=int, default=0)
+    parser.add_global_option('--procs', '-p', destvar='procs', type=int, default=-1)
+    args, _ = parser.parse(argv)
+
+    _warm_up(args.procs)
+    cache = DataCache(args.cache_size) if args.cache_size > 0 else None
+    with _listen(args.socket) as server_socket:
+        logging.info(f'Scuttle server listening on {args.socket}')
+        while True:
+            conn, _ = server_socket.accept()
+            with conn:
+                _handle_connection(conn, cache)
+
+
+def run_remote(socket_path, global_args, command_list):
+    """
+    Sends the commands to the server listening on socket_path, and relays its output.
+    Returns False if the server can't be reached (so the commands should be run locally)
+    """
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_path)
+    except OSError as e:
+        logging.warning(f'Could not connect to scuttle server at {socket_path} ({e}).  Running locally')
+        client_socket.close()
+        return False
+    with client_socket, client_socket.makefile('rb') as incoming:
+        _send(client_socket, (os.getcwd(), global_args, command_list))
+        while True:
+            message = _receive(incoming)
+            if message is None:
+                logging.critical('Lost connection to the scuttle server')
+                exit(1)
+            kind, payload = message
+            if kind == 'log':
+                record = logging.makeLogRecord(payload)
+                logging.getLogger(record.name).handle(record)
+            elif kind == 'stdout':
+                sys.stdout.write(payload)
+            elif kind == 'exit':
+                sys.stdout.flush()
+                if payload != 0:
+                    exit(payload)
+                return True
+
+
+def _warm_up(n_procs):
+    logging.info('Loading scanpy')
+    import scanpy  # noqa: F401
+    logging.info('Initializing R and DropletUtils')
+    try:
+        from scuttle.r.dropletutils import DropletUtils
+        DropletUtils.session(n_procs=n_procs)
+    except Exception as e:
+        logging.warning(f'Could not initialize R ({e}).  It will be initialized on first use instead')
+
+
+@contextlib.contextmanager
+def _listen(socket_path):
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            # Left over from a server that didn't shut down cleanly
+            os.remove(socket_path)
+        else:
+            logging.critical(f'Another scuttle server is already listening on {socket_path}')
+            exit(1)
+        finally:
+            probe.close()
+    _check_socket_directory(os.path.dirname(os.path.abspath(socket_path)))
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Only this user can connect - the socket is created that way, rather than changed after it's bound
+        umask = os.umask(0o177)
+        try:
+            server_socket.bind(socket_path)
+        finally:
+            os.umask(umask)
+        server_socket.listen()
+        yield server_socket
+    finally:
+        server_socket.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def _check_socket_directory(directory):
+    """
+    Creates directory (only accessible to this user) if it doesn't exist.  If anyone else could replace the
+    socket in it, clients could be tricked into sending their commands to someone else's server
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid():
+        logging.critical(f'{directory} belongs to another user, so it cannot hold the server socket')
+        exit(1)
+    if info.st_mode & 0o022 and not info.st_mode & stat.S_ISVTX:
+        logging.critical(f'Other users can write to {directory}, so it cannot hold the server socket '
+                         f'(try chmod go-w {directory})')
+        exit(1)
+
+
+def _handle_connection(conn, cache):
+    with conn.makefile('rb') as incoming:
+        message = _receive(incoming)
+    if message is None:
+        return
+    cwd, global_args, command_list = message
+    forwarder = _ForwardingHandler(conn)
+    logging.getLogger().addHandler(forwarder)
+    exit_code = 0
+    try:
+        os.chdir(cwd)
+        history.reset()
+        with contextlib.redirect_stdout(_ForwardingStream(conn)):
+            run(global_args, command_list, cache=cache)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        logging.exception('Command failed')
+        exit_code = 1
+    finally:
+        logging.getLogger().removeHandler(forwarder)
+        # Don't hold on to this run's matrix (or R's copy of it) while waiting for the next client
+        matrixcache.clear()
+        select.clear_caches()
+    with contextlib.suppress(OSError):
+        _send(conn, ('exit', exit_code))
+
+
+def _send(sock, message):
+    payload = pickle.dumps(message)
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _receive(incoming):
+    """Returns None if the other end hung up"""
+    header = incoming.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    (length,) = _HEADER.unpack(header)
+    payload = incoming.read(length)
+    if len(payload) < length:
+        return None
+    return pickle.loads(payload)
+
+
+class _ForwardingHandler(logging.Handler):
+    """
+    Sends log records to the client, which logs them as if they were its own
+    """
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+
+    def emit(self, record):
+        # Same approach as logging.handlers.SocketHandler - the arguments might not be picklable,
+        # so send the formatted message instead
+        attributes = dict(record.__dict__)
+        attributes['msg'] = record.getMessage()
+        attributes['args'] = None
+        attributes['exc_info'] = None
+        if record.exc_info:
+            attributes['msg'] += '\n' + logging.Formatter().formatException(record.exc_info)
+        with contextlib.suppress(OSError):
+            _send(self.conn, ('log', attributes))
+
+
+class _ForwardingStream:
+    """
+    A write-only file-like object that sends everything written to it to the client's stdout
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        with contextlib.suppress(OSError):
+            _send(self.conn, ('stdout', text))
+        return len(text)
+
+    def flush(self):
+        pass
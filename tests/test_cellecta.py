@@ -0,0 +1,212 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import collections
+import gzip
+
+import anndata
+import numpy as np
+import pytest
+
+from scuttle.commands.cellecta import assign_tags, barcode
+
+_BASES = np.array(list('ACGT'))
+_SUFFIX = '-1'
+
+
+def _sequence(rng, length):
+    return ''.join(rng.choice(_BASES, length))
+
+
+def _mutate(rng, sequence, n_mismatches):
+    """
+    sequence with n_mismatches bases changed, spread out so that they fall in different pigeonhole segments
+    """
+    bases = list(sequence)
+    for position in np.linspace(0, len(sequence) - 1, n_mismatches).astype(int) if n_mismatches else []:
+        bases[position] = rng.choice([base for base in 'ACGT' if base != bases[position]])
+    return ''.join(bases)
+
+
+def _distant(rng, length, others, distance):
+    """
+    A random sequence that differs from each of others at more than distance positions
+    """
+    while True:
+        sequence = _sequence(rng, length)
+        if all(sum(a != b for a, b in zip(sequence, other)) > distance for other in others):
+            return sequence
+
+
+def _write_tags(path, tags):
+    with open(path, 'w') as f:
+        for bc_id, sequence in tags.items():
+            f.write(f'{bc_id}\t{sequence}\n')
+
+
+def _write_fastq(path, sequences):
+    with gzip.open(path, 'wt') as f:
+        for number, sequence in enumerate(sequences):
+            f.write(f'@read{number}\n{sequence}\n+\n{"F" * len(sequence)}\n')
+
+
+class _Experiment:
+    """
+    Synthetic tag files, cells, and FASTQ pairs, along with what assign_tags should make of them
+    """
+    def __init__(self, tmp_path, n_pairs=2, reads_per_pair=300):
+        rng = np.random.default_rng(0)
+        bc14 = {}
+        for number in range(3):
+            bc14[f'A{number}'] = _distant(rng, 14, bc14.values(), barcode.MAX_MISMATCHES * 2)
+        bc30 = {}
+        for number in range(2):
+            bc30[f'B{number}'] = _distant(rng, 30, bc30.values(), barcode.MAX_MISMATCHES * 2)
+        self.bc14_file = tmp_path / 'bc14.txt'
+        self.bc30_file = tmp_path / 'bc30.txt'
+        _write_tags(self.bc14_file, bc14)
+        _write_tags(self.bc30_file, bc30)
+        cells = [_sequence(rng, 16) for _ in range(6)]
+        self.data = anndata.AnnData(np.zeros((len(cells), 1), dtype=np.float32))
+        self.data.obs_names = [cell + _SUFFIX for cell in cells]
+        # A few UMIs per cell, so that the same molecule is read more than once
+        umis = [_sequence(rng, barcode.UMI_LENGTH) for _ in range(3)]
+        unlisted = _sequence(rng, 16)
+        uncorrectable = _distant(rng, 14, bc14.values(), barcode.MAX_MISMATCHES)
+
+        self.reads = collections.Counter()
+        self.molecules = set()
+        self.funnel = collections.Counter()
+        self.fastq_pairs = []
+        for pair in range(n_pairs):
+            read1 = []
+            read2 = []
+            for _ in range(reads_per_pair):
+                # Most cells mostly see one tag, so that some are assigned and some are doublets
+                cell = rng.integers(len(cells))
+                bc14_id, bc30_id = (f'A{cell % 3}', f'B{cell % 2}') if rng.random() < 0.8 else \
+                    (f'A{rng.integers(3)}', f'B{rng.integers(2)}')
+                umi = umis[rng.integers(len(umis))]
+                n_mismatches = rng.choice([0, 0, 1, barcode.MAX_MISMATCHES])
+                r1 = cells[cell] + umi + 'TTTT' + 'T' * 10
+                r2 = _mutate(rng, bc14[bc14_id], n_mismatches) + 'TGGT' + bc30[bc30_id]
+                kind = rng.choice(['tagged'] * 6 + ['no_r1_anchor', 'no_r2_anchor', 'unlisted', 'uncorrectable'])
+                if kind == 'no_r1_anchor':
+                    r1 = r1[:26] + 'GGGG' + r1[30:]
+                elif kind == 'no_r2_anchor':
+                    r2 = r2[:14] + 'AAAA' + r2[18:]
+                elif kind == 'unlisted':
+                    r1 = unlisted + r1[16:]
+                elif kind == 'uncorrectable':
+                    r2 = uncorrectable + r2[14:]
+                read1.append(r1)
+                read2.append(r2)
+
+                self.funnel['reads'] += 1
+                if kind == 'no_r1_anchor':
+                    continue
+                self.funnel['r1_anchored'] += 1
+                if kind == 'no_r2_anchor':
+                    continue
+                self.funnel['r2_anchored'] += 1
+                if kind == 'unlisted':
+                    continue
+                self.funnel['whitelisted'] += 1
+                if kind == 'uncorrectable':
+                    self.funnel['failed_tags'] += 1
+                    continue
+                self.funnel['exact_tags' if n_mismatches == 0 else 'corrected_tags'] += 1
+                key = (self.data.obs_names[cell], f'{bc14_id}:{bc30_id}')
+                self.reads[key] += 1
+                self.molecules.add(key + (umi,))
+            paths = (tmp_path / f'pair{pair}_R1.fastq.gz', tmp_path / f'pair{pair}_R2.fastq.gz')
+            _write_fastq(paths[0], read1)
+            _write_fastq(paths[1], read2)
+            self.fastq_pairs.append(tuple(str(path) for path in paths))
+
+    def expected_counts(self, count):
+        if count == 'reads':
+            return dict(self.reads)
+        return dict(collections.Counter(molecule[:2] for molecule in self.molecules))
+
+
+def _counts(data):
+    matrix = data.obsm['cellecta_counts'].tocoo()
+    tags = data.uns['cellecta']['tags']
+    return {(data.obs_names[row], tags[col]): value for row, col, value in zip(matrix.row, matrix.col, matrix.data)}
+
+
+def test_correct_code(tmp_path):
+    rng = np.random.default_rng(1)
+    tags = {}
+    for number in range(4):
+        tags[f'T{number}'] = _distant(rng, 14, tags.values(), 2 * barcode.MAX_MISMATCHES + 1)
+    path = tmp_path / 'tags.txt'
+    _write_tags(path, tags)
+    corpus = barcode.TagCorpus(str(path))
+    np.testing.assert_array_equal(corpus.ids, list(tags))
+    for code, sequence in enumerate(tags.values()):
+        for n_mismatches in range(barcode.MAX_MISMATCHES + 1):
+            assert corpus.correct_code(_mutate(rng, sequence, n_mismatches)) == code
+        assert corpus.correct_code(_mutate(rng, sequence, barcode.MAX_MISMATCHES + 1)) == -1
+    # Only sequences of the same length can be corrected
+    assert corpus.correct_code(tags['T0'][:-1]) == -1
+    np.testing.assert_array_equal(corpus.exact(np.array([tags['T1'], _mutate(rng, tags['T1'], 1)], dtype=bytes)),
+                                  [True, False])
+
+
+def test_correct_code_prefers_file_order(tmp_path):
+    rng = np.random.default_rng(2)
+    sequence = _sequence(rng, 14)
+    # Both tags are within MAX_MISMATCHES of the read; T0's second sequence isn't
+    first = _mutate(rng, sequence, 1)
+    second = sequence[:-1] + ('A' if sequence[-1] != 'A' else 'C')
+    path = tmp_path / 'tags.txt'
+    _write_tags(path, {'T0': first, 'T1': second})
+    with open(path, 'a') as f:
+        f.write(f'T0\t{_distant(rng, 14, [sequence, first, second], barcode.MAX_MISMATCHES)}\n')
+    corpus = barcode.TagCorpus(str(path))
+    assert list(corpus.ids) == ['T0', 'T1']
+    assert corpus.correct(sequence) == 'T0'
+
+
+@pytest.mark.parametrize('count', ['reads', 'umis'])
+@pytest.mark.parametrize('n_proc', [1, 2, 3])
+def test_assign_tags(tmp_path, monkeypatch, count, n_proc):
+    # Small blocks and batches, so that reads are split across both of them (3 workers is more than there are
+    # FASTQ pairs, so the parent does the reading)
+    monkeypatch.setattr(assign_tags, '_BLOCK_SIZE', 1000)
+    monkeypatch.setattr(assign_tags, '_BATCH_SIZE', 37)
+    experiment = _Experiment(tmp_path)
+    data = experiment.data
+    assign_tags.assign_tags(data, experiment.fastq_pairs, str(experiment.bc14_file), str(experiment.bc30_file),
+                            _SUFFIX, n_proc=n_proc, count=count)
+
+    expected = experiment.expected_counts(count)
+    assert _counts(data) == expected
+    funnel = data.uns['cellecta']['funnel']
+    for name in assign_tags._Funnel.COUNTERS[:-2]:
+        assert funnel[name] == experiment.funnel[name], name
+    assert data.uns['cellecta']['count'] == count
+
+    confident = collections.defaultdict(list)
+    for (cell, tag), value in expected.items():
+        if value > 1:
+            confident[cell].append(tag)
+    for cell in data.obs_names:
+        assert data.obs.loc[cell, 'doublet'] == (len(confident[cell]) > 1)
+        assert data.obs.loc[cell, 'tags'] == (confident[cell][0] if len(confident[cell]) == 1 else '')
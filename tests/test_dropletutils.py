@@ -0,0 +1,98 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from scuttle.native import dropletutils
+
+
+def _barcodes():
+    """
+    2000 ambient barcodes drawn from one profile, and 150 cells drawn from another, as float32 (like most h5ad)
+    """
+    rng = np.random.default_rng(0)
+    ambient_profile = rng.dirichlet(np.ones(50))
+    cell_profile = rng.dirichlet(np.full(50, 0.3))
+    rows = [rng.multinomial(total, ambient_profile) for total in rng.integers(1, 80, 2000)]
+    rows += [rng.multinomial(total, cell_profile) for total in rng.integers(300, 3000, 150)]
+    return scipy.sparse.csr_matrix(np.array(rows, dtype=np.float32))
+
+
+def test_adjust_bh():
+    # p.adjust(c(0.01, 0.04, 0.03, 0.005, NA), method='BH')
+    adjusted = dropletutils.adjust_bh(np.array([0.01, 0.04, 0.03, 0.005, np.nan]))
+    np.testing.assert_allclose(adjusted, [0.02, 0.04, 0.04, 0.02, np.nan])
+
+
+def test_adjust_bh_caps_at_one():
+    np.testing.assert_allclose(dropletutils.adjust_bh(np.array([0.9, 0.95, 1.0])), [1.0, 1.0, 1.0])
+
+
+def test_good_turing_proportions():
+    counts = np.array([0, 0, 1, 1, 1, 2, 2, 3, 5, 8, 0])
+    proportions = dropletutils.good_turing_proportions(counts)
+    assert proportions.sum() == pytest.approx(1)
+    # The unseen genes share the Turing estimate of the unseen mass (singletons / total), equally
+    np.testing.assert_allclose(proportions[counts == 0], 3 / counts.sum() / 3)
+    # Genes with the same count get the same proportion, and (among the genes that were seen) more counts never
+    # means a smaller one
+    assert len(np.unique(proportions[counts == 1])) == 1
+    seen = np.flatnonzero(counts > 0)
+    order = seen[np.argsort(counts[seen], kind='stable')]
+    assert np.all(np.diff(proportions[order]) >= 0)
+
+
+def test_barcode_ranks_from_totals_ranks():
+    # rank(-totals, ties.method='average'), as in barcodeRanks
+    ranks, _ = dropletutils.barcode_ranks_from_totals(np.array([500, 300, 300, 200, 1000, 150, 120, 110, 5]),
+                                                      lower=100)
+    np.testing.assert_allclose(ranks['rank'], [2, 3.5, 3.5, 5, 1, 6, 7, 8, 9])
+
+
+def test_barcode_ranks_knee_is_a_total():
+    x = _barcodes()
+    totals = np.asarray(x.sum(axis=1, dtype=np.float64)).ravel()
+    _, metadata = dropletutils.barcode_ranks(x)
+    # Regression values for this data set
+    assert metadata['knee'] == 1601
+    assert metadata['inflection'] == 499
+    assert metadata['knee'] in totals
+    _, from_totals = dropletutils.barcode_ranks_from_totals(totals.astype(np.int64))
+    assert from_totals == metadata
+
+
+def test_empty_drops_retains_barcode_at_knee():
+    x = _barcodes()
+    totals = np.asarray(x.sum(axis=1, dtype=np.float64)).ravel()
+    result, metadata = dropletutils.empty_drops(x, niters=200, seed=0)
+    at_knee = totals == metadata['retain']
+    assert at_knee.any()
+    assert (result['FDR'][at_knee] == 0).all()
+    assert (result['FDR'][totals > 100] <= 0.01).sum() == 150
+
+
+@pytest.mark.parametrize('n_procs', [1, 3])
+def test_empty_drops_is_deterministic(n_procs):
+    # With a low ambient cutoff, plenty of ambient barcodes are tested, so the p-values depend on the simulation
+    x = _barcodes()
+    reference, _ = dropletutils.empty_drops(x, lower=5, niters=2500, seed=1, n_procs=1)
+    result, _ = dropletutils.empty_drops(x, lower=5, niters=2500, seed=1, n_procs=n_procs)
+    np.testing.assert_array_equal(result['PValue'], reference['PValue'])
+    other, _ = dropletutils.empty_drops(x, lower=5, niters=2500, seed=2, n_procs=n_procs)
+    assert not np.array_equal(other['PValue'], reference['PValue'], equal_nan=True)
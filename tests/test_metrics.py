@@ -0,0 +1,86 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from scuttle import metrics
+from scuttle.commands import CommandParser, add_subcommands_to_parser
+
+
+def _data():
+    """
+    10 cells with one count of each of 3 genes (one mitochondrial), and an annotation of 2 to promote
+    """
+    return anndata.AnnData(scipy.sparse.csr_matrix(np.ones((10, 3), dtype=np.float32)),
+                           obs=pd.DataFrame({'extra': np.full(10, 2.0)}, index=[f'cell{i}' for i in range(10)]),
+                           var=pd.DataFrame(index=['A', 'B', 'MT-C']))
+
+
+def _run(data, *argv):
+    parser = CommandParser()
+    add_subcommands_to_parser(parser)
+    _, commands = parser.parse(list(argv))
+    for command in commands:
+        command.validate()
+        command.execute(data)
+
+
+def test_recomputed_after_promote_and_select():
+    data = _data()
+    metrics.ensure(data, ['total_umis', 'pct_mito', 'num_cells'])
+    np.testing.assert_array_equal(data.obs['total_umis'], 3)
+    fingerprint = data.uns['qc_metrics']['total_umis']
+
+    _run(data, 'promote', 'extra')
+    metrics.ensure(data, ['total_umis', 'pct_mito', 'num_cells'])
+    assert data.uns['qc_metrics']['total_umis'] != fingerprint
+    np.testing.assert_array_equal(data.obs['total_umis'], 5)
+    np.testing.assert_allclose(data.obs['pct_mito'], 20)
+    np.testing.assert_array_equal(data.var['num_cells'], 10)
+
+    # Keeps only the promoted gene, and then refers to the cell metrics, which have to be recomputed without
+    # the genes that were removed
+    _run(data, 'select', 'genes', 'mean_counts > 1', 'select', 'cells', 'total_umis == 2')
+    assert list(data.var_names) == ['extra']
+    assert data.n_obs == 10
+    metrics.ensure(data, ['total_umis', 'pct_mito'])
+    np.testing.assert_array_equal(data.obs['total_umis'], 2)
+    np.testing.assert_array_equal(data.obs['pct_mito'], 0)
+
+    # Removing cells doesn't change the cell metrics, only the gene metrics
+    fingerprints = dict(data.uns['qc_metrics'])
+    _run(data, 'select', 'cells', 'sample', '4')
+    metrics.ensure(data, ['total_umis', 'num_cells'])
+    assert data.uns['qc_metrics']['total_umis'] == fingerprints['total_umis']
+    assert data.uns['qc_metrics']['num_cells'] != fingerprints['num_cells']
+    np.testing.assert_array_equal(data.var['num_cells'], 4)
+
+
+def test_user_annotation_untouched():
+    data = _data()
+    provided = np.arange(10, dtype=float)
+    data.obs['total_umis'] = provided
+    metrics.ensure(data, ['total_umis', 'num_genes'])
+    np.testing.assert_array_equal(data.obs['total_umis'], provided)
+    assert 'total_umis' not in data.uns['qc_metrics']
+    np.testing.assert_array_equal(data.obs['num_genes'], 3)
+
+    _run(data, 'promote', 'extra', 'select', 'cells', 'total_umis < 4')
+    np.testing.assert_array_equal(data.obs['total_umis'], [0, 1, 2, 3])
@@ -0,0 +1,44 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+
+import anndata
+import numpy as np
+
+from scuttle.readwrite import DataCache
+
+
+def test_cache_serves_subsets(tmp_path):
+    filename = tmp_path / 'data.h5ad'
+    data = anndata.AnnData(np.ones((3, 2), dtype=np.float32))
+    data.write(filename)
+    cache = DataCache(2)
+    cache.put(filename, {'X', 'obs', 'var', 'uns'}, data, {'layers', 'obsm'})
+
+    cached, loaded, skipped = cache.get(filename, {'obs', 'var', 'uns'})
+    assert loaded == {'X', 'obs', 'var', 'uns'}
+    assert skipped == {'layers', 'obsm'}
+    # Changing the copy that was handed out doesn't change the cached one
+    cached.X[0, 0] = 5
+    assert cache.get(filename, {'X'})[0].X[0, 0] == 1
+    assert cache.get(filename, {'X', 'layers'}) is None
+
+    # A rewritten file isn't served from the cache
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert cache.get(filename, {'obs'}) is None
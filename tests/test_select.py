@@ -0,0 +1,174 @@
+# scuttle - manage and manipulate sc-rna data files
+# Copyright (C) 2019 Phillip Dexheimer
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import ast
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+from scuttle.commands import CommandParser, add_subcommands_to_parser, select
+
+
+def _data():
+    totals = np.arange(100)
+    return anndata.AnnData(scipy.sparse.csr_matrix(np.ones((100, 3), dtype=np.float32)),
+                           obs=pd.DataFrame({'total': totals}, index=[f'cell{i}' for i in totals]),
+                           var=pd.DataFrame(index=['A', 'B', 'C']))
+
+
+def _run(data, *argv):
+    parser = CommandParser()
+    add_subcommands_to_parser(parser)
+    _, commands = parser.parse(list(argv))
+    for command in commands:
+        command.validate()
+        command.execute(data)
+
+
+def test_sample_from_expression():
+    data = _data()
+    _run(data, 'select', 'cells', 'total >= 90', 'sample', '5')
+    assert data.n_obs == 5
+    assert (data.obs['total'] >= 90).all()
+
+
+def test_top_from_expression():
+    data = _data()
+    _run(data, 'select', 'cells', 'total < 50', 'top', '3', 'by', 'total')
+    assert sorted(data.obs['total']) == [47, 48, 49]
+
+
+def test_fraction_without_expression():
+    data = _data()
+    _run(data, 'select', 'cells', 'fraction', '0.1', '--seed', '3')
+    assert data.n_obs == 10
+
+
+def test_expression_only():
+    data = _data()
+    _run(data, 'select', 'cells', 'total < 10')
+    assert data.n_obs == 10
+
+
+def _annotated_data():
+    """
+    Cells with every kind of annotation the compiler handles specially, including missing values
+    """
+    rng = np.random.default_rng(0)
+    n = 300
+    a = rng.normal(1, 2, n)
+    a[::17] = np.nan
+    category = pd.Categorical(rng.choice(['x', 'y', 'z'], n))
+    category[::23] = np.nan
+    obs = pd.DataFrame({
+        'a': a,
+        'b': rng.integers(1, 10, n),
+        'big': rng.integers(0, 2 ** 63, n, dtype=np.uint64) + np.uint64(2 ** 63 - 1),
+        'small': rng.integers(0, 100, n).astype(np.uint32),
+        'category': category,
+        'flag': rng.random(n) < 0.3,
+    }, index=[f'cell{i}' for i in range(n)])
+    genes = ['G0', 'G1', 'G2', 'MT-1', 'MT-2']
+    x = scipy.sparse.random(n, len(genes), density=0.5, random_state=1, format='csr', dtype=np.float32)
+    x.data = np.ceil(x.data * 5)
+    return anndata.AnnData(x, obs=obs, var=pd.DataFrame(index=genes))
+
+
+@pytest.fixture(params=['numpy', 'numexpr'])
+def engine(request, monkeypatch):
+    if request.param == 'numexpr':
+        pytest.importorskip('numexpr')
+    else:
+        monkeypatch.setattr(select, '_import_numexpr', lambda: None)
+    # Small chunks, so that several chunks (and several threads) are used
+    monkeypatch.setattr(select, '_CHUNK_ROWS', 64)
+    return request.param
+
+
+def _genes(data, *names):
+    return np.asarray(data[:, list(names)].X.sum(axis=1)).ravel()
+
+
+# Each expression, and the same selection written directly with pandas/numpy (which is how the original,
+# row-at-a-time evaluator computed it - missing values never satisfy a comparison)
+_EXPRESSIONS = {
+    'a / b > 0.2': lambda d: d.obs['a'] / d.obs['b'] > 0.2,
+    '1 < b <= 5': lambda d: (d.obs['b'] > 1) & (d.obs['b'] <= 5),
+    '-a < 0 < b': lambda d: (-d.obs['a'] < 0) & (d.obs['b'] > 0),
+    'b % 3 == 0 or a ** 2 < 4': lambda d: (d.obs['b'] % 3 == 0) | (d.obs['a'] ** 2 < 4),
+    'b // 2 == 2': lambda d: d.obs['b'] // 2 == 2,
+    'a > 1 and b > 3': lambda d: (d.obs['a'] > 1) & (d.obs['b'] > 3),
+    'a > 1 or b > 3': lambda d: (d.obs['a'] > 1) | (d.obs['b'] > 3),
+    'b > 8 and a > 1 and a < 3': lambda d: (d.obs['b'] > 8) & (d.obs['a'] > 1) & (d.obs['a'] < 3),
+    'not a > 1': lambda d: ~(d.obs['a'] > 1),
+    'category == "x"': lambda d: d.obs['category'] == 'x',
+    'category != "x"': lambda d: d.obs['category'] != 'x',
+    '"y" == category or b == 1': lambda d: (d.obs['category'] == 'y') | (d.obs['b'] == 1),
+    'flag': lambda d: d.obs['flag'],
+    'not flag': lambda d: ~d.obs['flag'],
+    'flag == True and b > 4': lambda d: d.obs['flag'] & (d.obs['b'] > 4),
+    'flag == 0': lambda d: ~d.obs['flag'],
+    'big > 12000000000000000000': lambda d: d.obs['big'] > 12000000000000000000,
+    'small + 1 > 50': lambda d: d.obs['small'] + 1 > 50,
+    'G1 > 2': lambda d: _genes(d, 'G1') > 2,
+    'G1 + G2 >= 3 and a > 0': lambda d: (_genes(d, 'G1') + _genes(d, 'G2') >= 3) & (d.obs['a'] > 0),
+    'sum(genes is "MT-.*") > 3': lambda d: _genes(d, 'MT-1', 'MT-2') > 3,
+    'sum(gene is not "MT-.*") / b < 1': lambda d: _genes(d, 'G0', 'G1', 'G2') / d.obs['b'] < 1,
+}
+
+
+@pytest.mark.parametrize('expression', _EXPRESSIONS)
+@pytest.mark.parametrize('n_procs', [1, 3])
+def test_compiled_matches_direct(engine, expression, n_procs):
+    data = _annotated_data()
+    mask = select.EvaluateFilter(data, 'cell', n_procs).visit(ast.parse(expression, mode='eval'))
+    np.testing.assert_array_equal(mask, np.asarray(_EXPRESSIONS[expression](data), dtype=bool))
+
+
+@pytest.mark.parametrize('operator', ['in', 'not in'])
+def test_in_file(engine, operator, tmp_path):
+    data = _annotated_data()
+    values = tmp_path / 'values.txt'
+    values.write_text('x\nz\n')
+    expression = f'category {operator} "{values}"'
+    mask = select.EvaluateFilter(data, 'cell').visit(ast.parse(expression, mode='eval'))
+    expected = data.obs['category'].isin(['x', 'z']).to_numpy()
+    if operator == 'not in':
+        # Missing values never match
+        expected = ~expected | data.obs['category'].isna().to_numpy()
+    np.testing.assert_array_equal(mask, expected)
+
+
+@pytest.mark.parametrize('dtype', [object, 'string', 'Int64'])
+def test_distinct_values_are_cached(dtype):
+    select.clear_caches()
+    data = _data()
+    # With a missing value, to_numpy() can't just return the Int64 array's own data
+    values = [None if i % 7 == 6 else i % 7 if dtype == 'Int64' else f'{i % 7}' for i in range(data.n_obs)]
+    data.obs['group'] = pd.array(values, dtype=dtype)
+    for _ in range(3):
+        evaluator = select.EvaluateFilter(data, 'cell')
+        codes, distinct = select._distinct_values(evaluator.annotation('group'))
+    # Every lookup after the first is a cache hit (extension arrays make a new copy from to_numpy() every time)
+    assert len(select._factorize_cache) == 1
+    assert len(distinct) == 6
+    found = pd.Series(np.asarray(distinct)[codes]).where(codes >= 0)
+    np.testing.assert_array_equal(found.isna(), data.obs['group'].isna())
+    np.testing.assert_array_equal(found[codes >= 0].astype(int), data.obs['group'].dropna().astype(int))